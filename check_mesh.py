@@ -0,0 +1,188 @@
+"""
+Check_mesh - sanity checks of the triangles drawn by the wrap_image and stamp_image programs
+
+There's no STL viewer in the loop, so a wrong winding or a gap in a mesh goes unnoticed until a slicer complains. The
+checks run on the arrays of triangles, without writing any files:
+
+    usage:
+        python check_mesh.py -i test_image.png -t 0.1 1.0
+
+    It prints a line for each check and exits with a non-zero status if any of them fail.
+
+    The primitives in utils are checked to face the way their docstrings say. The image is simplified at each
+    tolerance, with and without reverse_x and a hole, and drawn the same way as wrap_image. Every directed edge of
+    the frieze must be paired with the same edge going the other way (so it's watertight and wound consistently), it
+    must face out (a positive volume), and every full resolution vertex must be within tolerance of the simplified
+    surface.
+"""
+
+import argparse
+import sys
+
+import numpy as np
+from PIL import Image
+
+import pystl
+import simplify
+import utils
+import wrap_image
+
+INNER_RADIUS = 70.0     # radii and hole radius the frieze is checked with, the same as the wrap_image defaults
+OUTER_RADIUS = 80.0
+HOLE_RADIUS = 40.0
+
+
+def calc_normals(triangles):
+    # the (unnormalized) normals of triangles of shape (n, 3, 3), from their winding
+    return np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+
+
+def check_facing(triangles, direction):
+    """
+    Return whether every triangle faces direction, either a vector or 'out' (away from the z axis). Triangles
+    without any area count as facing the wrong way.
+    """
+    normals = calc_normals(triangles)
+    if isinstance(direction, str):
+        centers = triangles.mean(axis=1)
+        facing = (normals[:, :2] * centers[:, :2]).sum(axis=1)
+    else:
+        facing = normals.dot(direction)
+    return bool((facing > 0.0).all())
+
+
+def check_primitives():
+    # the primitives in utils face the way their docstrings say
+    up, down = (0.0, 0.0, 1.0), (0.0, 0.0, -1.0)
+    return [
+        ('tube_triangles faces out', check_facing(utils.tube_triangles(10.0, 16, 0.0, 5.0), 'out')),
+        ('disc_triangles faces up', check_facing(utils.disc_triangles(10.0, 16, 0.0), up)),
+        ('annulus_triangles faces up', check_facing(utils.annulus_triangles(5.0, 10.0, 16, 0.0), up)),
+        ('disc_with_rect_hole_triangles faces down',
+         check_facing(utils.disc_with_rect_hole_triangles(10.0, 20, 0.0, 4.0, 3.0), down)),
+    ]
+
+
+def count_unpaired_edges(triangles):
+    """
+    Return the number of directed edges of the triangles, of shape (n, 3, 3), that aren't paired with exactly one
+    edge going the other way. Vertices are matched by their coordinates.
+    """
+    _, ids = np.unique(triangles.reshape(-1, 3), axis=0, return_inverse=True)
+    ids = ids.reshape(-1, 3)
+    num_ids = ids.max() + 1
+    edges = np.concatenate((ids[:, [0, 1]], ids[:, [1, 2]], ids[:, [2, 0]]))
+    keys, counts = np.unique(edges[:, 0] * num_ids + edges[:, 1], return_counts=True)
+    reverse_keys = (keys % num_ids) * num_ids + keys // num_ids
+    reverse_counts = np.zeros(len(keys), dtype=int)
+    found = np.isin(reverse_keys, keys)
+    reverse_counts[found] = counts[np.searchsorted(keys, reverse_keys[found])]
+    return int(np.count_nonzero((counts != 1) | (reverse_counts != 1)))
+
+
+def calc_volume(triangles):
+    # the signed volume inside the triangles - positive if they face out
+    return np.einsum('ij,ij->i', triangles[:, 0], np.cross(triangles[:, 1], triangles[:, 2])).sum() / 6.0
+
+
+def calc_segment_distances(points, a, b):
+    # the distance from each point to the segment from a to b
+    ab = b - a
+    t = np.clip(((points - a) * ab).sum(axis=1) / np.maximum((ab * ab).sum(axis=1), 1e-30), 0.0, 1.0)
+    return np.linalg.norm(points - (a + t[:, np.newaxis] * ab), axis=1)
+
+
+def calc_triangle_distances(points, triangles):
+    # the distance from each point to the triangle (shape (n, 3, 3)) paired with it
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    normals = np.cross(b - a, c - a)
+    normals /= np.linalg.norm(normals, axis=1)[:, np.newaxis]
+    heights = ((points - a) * normals).sum(axis=1)
+    projected = points - heights[:, np.newaxis] * normals
+
+    # the projection is inside the triangle if it's on the inner side of all three edges
+    inside = np.ones(len(points), dtype=bool)
+    for p, q in ((a, b), (b, c), (c, a)):
+        inside &= (np.cross(q - p, projected - p) * normals).sum(axis=1) >= 0.0
+
+    edges = np.min([calc_segment_distances(points, p, q) for p, q in ((a, b), (b, c), (c, a))], axis=0)
+    return np.where(inside, np.abs(heights), edges)
+
+
+def calc_surface_error(vertices, triangles):
+    """
+    Return the largest distance from a full resolution vertex to the simplified surface. Each vertex is measured
+    against the triangles it's inside of in the (column, row) space of the grid, which is at least as far as the
+    nearest part of the surface.
+    """
+    width, height, _ = vertices.shape
+    points = vertices.reshape(-1, 3)
+    ti, tj = triangles // height, triangles % height
+
+    # the triangles across the seam use column width for column 0
+    at_seam = (ti.max(axis=1) - ti.min(axis=1)) > width // 2
+    ti[at_seam] = np.where(ti[at_seam] < width // 2, ti[at_seam] + width, ti[at_seam])
+
+    # every grid position in the bounding box of each triangle
+    i_min, j_min = ti.min(axis=1), tj.min(axis=1)
+    box_w, box_h = ti.max(axis=1) - i_min + 1, tj.max(axis=1) - j_min + 1
+    counts = box_w * box_h
+    tri = np.repeat(np.arange(len(triangles)), counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    pi = i_min[tri] + offset // box_h[tri]
+    pj = j_min[tri] + offset % box_h[tri]
+
+    # keep the positions inside (or on the edge of) their triangle
+    def side(i1, j1, i2, j2, i, j):
+        # positive if (i, j) is to the left of the line from (i1, j1) to (i2, j2)
+        return (i2 - i1) * (j - j1) - (j2 - j1) * (i - i1)
+
+    ci, cj = ti[tri], tj[tri]
+    winding = np.sign(side(ci[:, 0], cj[:, 0], ci[:, 1], cj[:, 1], ci[:, 2], cj[:, 2]))
+    inside = np.ones(len(tri), dtype=bool)
+    for k in range(3):
+        inside &= side(ci[:, k], cj[:, k], ci[:, (k+1) % 3], cj[:, (k+1) % 3], pi, pj) * winding >= 0
+
+    tri, pi, pj = tri[inside], pi[inside] % width, pj[inside]
+    return calc_triangle_distances(points[pi * height + pj], points[triangles[tri]]).max()
+
+
+def check_simplified(im, tolerance, reverse_x=False, add_hole=False):
+    # simplify the image and draw it like wrap_image does, keeping the triangles in memory
+    vertices = wrap_image.calc_vertices(im, INNER_RADIUS, OUTER_RADIUS, 1.0, reverse_x=reverse_x)
+    triangles, end_columns = simplify.simplify_mesh(vertices, tolerance, reverse_x)
+
+    stl = pystl.FacetBuffer()
+    ends = wrap_image.draw_mesh(stl, vertices, triangles, end_columns)
+    wrap_image.draw_end_caps(stl, ends, 0, reverse_x, add_hole=add_hole, hole_radius=HOLE_RADIUS)
+    wrap_image.draw_end_caps(stl, ends, 1, reverse_x, add_hole=add_hole, reverse_normal=True, hole_radius=HOLE_RADIUS)
+    if add_hole:
+        wrap_image.draw_hole(stl, ends, HOLE_RADIUS, reverse_x)
+    frieze = stl.get_triangles()
+
+    name = "tolerance={}, reverse_x={}, hole={} ({} facets)".format(tolerance, reverse_x, add_hole, len(frieze))
+    error = calc_surface_error(vertices, triangles)
+    return [
+        ('every edge is paired - ' + name, count_unpaired_edges(frieze) == 0),
+        ('faces out - ' + name, calc_volume(frieze) > 0.0),
+        ('vertices within {:.4f} mm of the surface - {}'.format(error, name), error <= tolerance),
+    ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the triangles drawn by wrap_image and stamp_image')
+    parser.add_argument('-i', '--image_file', type=str, help='Image to simplify', default='test_image.png')
+    parser.add_argument('-t', '--tolerance', type=float, nargs='+', help='Tolerances to simplify the image to (floats)', default=[0.1, 1.0])
+    args = parser.parse_args()
+
+    im = Image.open(args.image_file).convert('L')
+    results = check_primitives()
+    for tolerance in args.tolerance:
+        for reverse_x in (False, True):
+            for add_hole in (False, True):
+                results += check_simplified(im, tolerance, reverse_x, add_hole)
+
+    for name, ok in results:
+        print("{} - {}".format('ok' if ok else 'FAILED', name))
+
+    sys.exit(0 if all(ok for _, ok in results) else 1)
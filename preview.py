@@ -0,0 +1,122 @@
+"""
+Preview - quick shaded images of the wrap_image and stamp_image height fields
+
+The previews are rendered straight from the vertex grid with numpy, without creating any triangles, so the
+parameters can be tuned in well under a second before committing to a full STL file. The grid is resampled onto the
+pixels of the preview and lit from the top left, with higher parts drawn lighter:
+
+    im = preview.render_relief(vertices)
+    im.save('preview.png')
+
+render_relief unrolls a wrapped cylinder (the angle around the cylinder across, z up), and render_stamp shows the
+face of a stamp as it's seen from below.
+"""
+
+import math
+
+import numpy as np
+from PIL import Image
+
+LIGHT = (-1.0, 1.0, 1.0)    # direction to the light - from the top left of the preview, and in front of it
+AMBIENT = 0.25              # amount of light that reaches faces turned away from the light
+BACKGROUND = 255            # grey level outside of the part
+
+
+def reduce_image(im, size):
+    """
+    Return the image shrunk (box filtered) so neither side is more than size pixels, and the factor it was shrunk
+    by. Each pixel of the shrunk image covers factor pixels of the original in each direction.
+    """
+    factor = max(int(math.ceil(max(im.width, im.height) / float(size))), 1)
+    return (im.reduce(factor) if factor > 1 else im), factor
+
+
+def downsample_grid(vertices, size):
+    """ Return every n'th vertex of the grid, so neither side of it is more than size vertices """
+    width, height, _ = vertices.shape
+    step = int(math.ceil(max(width, height) / float(size)))
+    return vertices[::step, ::step] if step > 1 else vertices
+
+
+def shade(heights, dy, dx):
+    """
+    Return the brightness (0.0-1.0) of each pixel of a height field, indexed [row][col] with rows going down, and
+    with pixels dx apart across and dy apart down. Faces lit head on are brightest, and higher parts are lighter.
+    """
+    dz_dy, dz_dx = np.gradient(heights, dy, dx)
+    light = np.array(LIGHT) / math.sqrt(sum(c * c for c in LIGHT))
+
+    # rows go down the image, so flip the y slope to get a y axis going up
+    normals = np.stack((-dz_dx, dz_dy, np.ones_like(heights)), axis=-1)
+    normals /= np.sqrt((normals ** 2).sum(axis=-1))[..., np.newaxis]
+    diffuse = np.clip(normals.dot(light), 0.0, 1.0)
+
+    low, high = heights.min(), heights.max()
+    tint = (heights - low) / (high - low) if high > low else np.ones_like(heights)
+    return (AMBIENT + (1.0 - AMBIENT) * diffuse) * (0.6 + 0.4 * tint)
+
+
+def to_image(brightness, mask=None):
+    """ Return a greyscale PIL image of the brightness, with BACKGROUND wherever mask is False """
+    pixels = np.round(brightness * 255.0).astype(np.uint8)
+    if mask is not None:
+        pixels[~mask] = BACKGROUND
+    return Image.fromarray(pixels, 'L')
+
+
+def render_relief(vertices, size=512):
+    """
+    Render the vertex grid of a wrapped image (from wrap_image.calc_vertices) unrolled, with the angle around the
+    cylinder going across and z going up. The height is the distance from the axis of the cylinder.
+    """
+    grid = downsample_grid(vertices, size)
+    width, height, _ = grid.shape
+    radii = np.hypot(grid[:, :, 0], grid[:, :, 1])
+
+    # one pixel per vertex, with the top row at the highest z
+    heights = radii.T[::-1]
+    dx = (math.pi * 2.0 * radii.mean()) / float(width)
+    dy = abs(grid[0, -1, 2] - grid[0, 0, 2]) / float(max(height - 1, 1))
+    return to_image(shade(heights, dy if dy > 0.0 else dx, dx))
+
+
+def render_stamp(vertices, outer_radius, size=512, margin_z=0.0):
+    """
+    Render the vertex grid of a stamp (from stamp_image.calc_stamp_vertices) as seen from below, with the image
+    inside the margin at margin_z on the bottom of a cylinder of outer_radius. Looking up at the bottom flips the
+    x axis, so the image appears the way the face of the printed stamp will.
+    """
+    grid = downsample_grid(vertices, size)
+    width, height, _ = grid.shape
+    min_x, max_x = grid[0, 0, 0], grid[-1, 0, 0]
+    min_y, max_y = grid[0, 0, 1], grid[0, -1, 1]
+
+    # pixel centers, across the cylinder from right to left (seen from below) and from top to bottom
+    pixel_size = 2.0 * outer_radius / float(size)
+    centers = (np.arange(size) + 0.5) * pixel_size - outer_radius
+    x = -centers[np.newaxis, :]
+    y = -centers[:, np.newaxis]
+
+    # nearest vertex of the grid for each pixel, and the margin everywhere else
+    i = np.clip(np.round((x - min_x) / (max_x - min_x) * (width - 1)), 0, width - 1).astype(int)
+    j = np.clip(np.round((y - min_y) / (max_y - min_y) * (height - 1)), 0, height - 1).astype(int)
+    in_image = (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+    z = np.where(in_image, grid[i, j, 2], margin_z)
+
+    # the stamp sticks out downward (toward the viewer), so lower is higher
+    mask = (x ** 2 + y ** 2) <= outer_radius ** 2
+    return to_image(shade(-z, pixel_size, pixel_size), mask)
+
+
+def side_by_side(images, spacing=8):
+    """ Return the images pasted next to each other, spacing pixels apart, on the background """
+    width = sum(im.width for im in images) + spacing * (len(images) - 1)
+    height = max(im.height for im in images)
+    sheet = Image.new('L', (width, height), BACKGROUND)
+    x = 0
+
+    for im in images:
+        sheet.paste(im, (x, 0))
+        x += im.width + spacing
+
+    return sheet
@@ -10,31 +10,149 @@ the context block:
 
 For debugging you can use text-based STL files (by passing in False for the bin parameter).
 
+If the number of triangles is known up front, pass it in as num_triangles and it will be written in the header of a
+binary STL file, so the file never needs to be seeked (e.g. when writing to a pipe).
+
+To overlap creating the geometry with writing it, pass in True for the threaded parameter. Triangles are then packed
+into chunks and written by a separate thread. At most queue_size chunks are waiting to be written at a time, so a slow
+disk holds up the caller rather than letting the chunks pile up in memory. Whole numpy arrays of triangles can be
+written in one call with add_triangles and add_quads.
+
+To draw something once and write it many times (e.g. moved to different places), draw it into a FacetBuffer and
+write its triangles, offset as needed, with add_triangles:
+
+    buffer = FacetBuffer()
+    buffer.add_triangle(t1)
+    stl.add_triangles(buffer.get_triangles() + (10.0, 0.0, 0.0))
+
 Len Wanger
 last updated: 02-15-2016
 """
 
 import math
+import queue
 import struct
+import threading
+
+import numpy as np
+
+BIN_HEADER_SIZE = 84    # 80 byte header and the number of triangles
+BIN_TRIANGLE_SIZE = 50  # normal, three vertices and the attribute byte count
+BIN_TRIANGLE_DTYPE = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attribute', '<u2')])
+QUEUE_SIZE = 8          # default number of chunks waiting for the writer thread
+
+# the most memory add_triangles uses for each facet of an array: the float64 triangles (72 bytes) and, while the
+# normals are worked out, the two edges (24 bytes each), their cross product (24), its length (8), the cross product
+# divided by the length (24) and the normals picked out of that (24). Packing the facets afterwards takes less.
+ADD_TRIANGLES_FACET_BYTES = 72 + 2 * 24 + 24 + 8 + 24 + 24
+
+
+def calc_bin_file_size(num_triangles):
+    """ Return the size in bytes of a binary STL file with num_triangles triangles """
+    return BIN_HEADER_SIZE + BIN_TRIANGLE_SIZE * num_triangles
+
+
+def quads_to_triangles(v1, v2, v3, v4):
+    """ Split arrays of quads into triangles the same way as add_quad, returning an array of shape (..., 2, 3, 3) """
+    return np.stack((np.stack((v1, v2, v4), axis=-2), np.stack((v2, v3, v4), axis=-2)), axis=-3)
+
+
+def calc_normals(triangles):
+    """ Return the unit normals for an array of triangles. Degenerate triangles get a normal of (0, 0, 0) """
+    u = triangles[:, 1] - triangles[:, 0]
+    v = triangles[:, 2] - triangles[:, 0]
+    n = np.cross(u, v)
+    l = np.sqrt(n[:, 0]**2 + n[:, 1]**2 + n[:, 2]**2)[:, np.newaxis]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(l > 0.0, n / l, 0.0)
+
 
 class PySTL(object):
-    def __init__(self, file_name, bin=True, model_name=''):
+    def __init__(self, file_name, bin=True, model_name='', num_triangles=None, threaded=False, queue_size=QUEUE_SIZE,
+                 chunk_size=4096):
         self.f = None
         self.model_name = model_name
         self.file_name = file_name
         self.is_bin = bin
         self.num_triangles = 0
+        self.expected_num_triangles = num_triangles
         self.trailer_written = False
+        self.threaded = threaded
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+        self.writer = None
+        self.write_queue = None
+        self.writer_error = None
+        self.buffer = []
 
 
     def open(self):
         file_mode = 'wb' if self.is_bin else 'w'
         self.f = open(self.file_name, file_mode)
 
+        if self.threaded:
+            self.write_queue = queue.Queue(self.queue_size)
+            self.writer = threading.Thread(target=self.write_queued, daemon=True)
+            self.writer.start()
+
 
     def close(self):
-        self.f.close()
-        self.f = None
+        try:
+            self.stop_writer()
+        finally:
+            self.f.close()
+            self.f = None
+
+
+    def write(self, data):
+        """ Write data to the file, or queue it up for the writer thread """
+        if self.writer is None:
+            self.f.write(data)
+        else:
+            self.buffer.append(data)
+            if len(self.buffer) >= self.chunk_size:
+                self.flush_buffer()
+
+
+    def flush_buffer(self):
+        if self.buffer:
+            chunk = b''.join(self.buffer) if self.is_bin else ''.join(self.buffer)
+            self.buffer = []
+            self.queue_chunk(chunk)
+
+
+    def queue_chunk(self, chunk):
+        if self.writer_error is not None:
+            raise self.writer_error
+        self.write_queue.put(chunk)
+
+
+    def write_queued(self):
+        """ Run on the writer thread - write chunks until a None comes off the queue """
+        while True:
+            chunk = self.write_queue.get()
+            if chunk is None:
+                break
+
+            # after an error keep draining the queue so the caller is never stuck waiting on it
+            if self.writer_error is None:
+                try:
+                    self.f.write(chunk)
+                except Exception as e:
+                    self.writer_error = e
+
+
+    def stop_writer(self):
+        """ Wait for everything queued to be written and stop the writer thread """
+        if self.writer is not None:
+            self.flush_buffer()
+            self.write_queue.put(None)
+            self.writer.join()
+            self.writer = None
+
+            if self.writer_error is not None:
+                raise self.writer_error
 
 
     def __enter__(self):
@@ -44,27 +162,37 @@ class PySTL(object):
 
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if not self.trailer_written:
-            self.write_stl_trailer()
-        self.close()
+        # if the with block raised, don't check the number of triangles so its error isn't replaced
+        try:
+            if not self.trailer_written and exc_type is None:
+                self.write_stl_trailer()
+        finally:
+            self.close()
 
 
     def write_stl_header(self):
         if self.is_bin:
             header_str = b''
-            self.f.write(struct.pack("80s", header_str))
+            self.write(struct.pack("80s", header_str))
             self.write_num_triangles_bin()
         else:
-            self.f.write('solid ' + self.model_name + '\n' )
+            self.write('solid ' + self.model_name + '\n' )
 
 
     def write_num_triangles_bin(self, write_num_triangles=False):
         if self.is_bin:
-            if write_num_triangles:
+            if self.expected_num_triangles is not None:
+                if not write_num_triangles:
+                    self.write(struct.pack("I", self.expected_num_triangles))
+                elif self.num_triangles != self.expected_num_triangles:
+                    raise RuntimeError('Expected {} triangles but {} were written.'.format(
+                        self.expected_num_triangles, self.num_triangles))
+            elif write_num_triangles:
+                self.stop_writer()
                 self.f.seek(80)
                 self.f.write(struct.pack("I", self.num_triangles))
             else:
-                self.f.write(struct.pack("I", 0))
+                self.write(struct.pack("I", 0))
         else:
             raise RuntimeError('Cannot call write_num_triangles_bin on a text STL file.')
 
@@ -74,7 +202,7 @@ class PySTL(object):
             self.write_num_triangles_bin(True)
         else:
             # No trailer on binary STL files
-            self.f.write('endsolid \n' )
+            self.write('endsolid \n' )
 
 
     def add_triangle(self, triangle, normal=None):
@@ -95,16 +223,16 @@ class PySTL(object):
                      triangle[1][0], triangle[1][1], triangle[1][2],
                      triangle[2][0], triangle[2][1], triangle[2][2],
                      0 ]
-            self.f.write(struct.pack("12fH", *data))
+            self.write(struct.pack("12fH", *data))
             self.num_triangles += 1
         else:
-            self.f.write('  facet normal {:.3f} {:.3f} {:.3f}\n'.format(normal[0], normal[1], normal[2]) )
-            self.f.write('    outer loop\n' )
-            self.f.write('      vertex {:.3f} {:.3f} {:.3f}\n'.format(triangle[0][0], triangle[0][1], triangle[0][2]))
-            self.f.write('      vertex {:.3f} {:.3f} {:.3f}\n'.format(triangle[1][0], triangle[1][1], triangle[1][2]))
-            self.f.write('      vertex {:.3f} {:.3f} {:.3f}\n'.format(triangle[2][0], triangle[2][1], triangle[2][2]))
-            self.f.write('    endloop\n' )
-            self.f.write('  endfacet \n')
+            self.write('  facet normal {:.3f} {:.3f} {:.3f}\n'.format(normal[0], normal[1], normal[2]) )
+            self.write('    outer loop\n' )
+            self.write('      vertex {:.3f} {:.3f} {:.3f}\n'.format(triangle[0][0], triangle[0][1], triangle[0][2]))
+            self.write('      vertex {:.3f} {:.3f} {:.3f}\n'.format(triangle[1][0], triangle[1][1], triangle[1][2]))
+            self.write('      vertex {:.3f} {:.3f} {:.3f}\n'.format(triangle[2][0], triangle[2][1], triangle[2][2]))
+            self.write('    endloop\n' )
+            self.write('  endfacet \n')
 
 
     def add_quad(self, v1, v2, v3, v4):
@@ -115,6 +243,40 @@ class PySTL(object):
         self.add_triangle((v2, v3, v4))
 
 
+    def add_triangles(self, triangles, normals=None):
+        """  Write an array of triangles to the STL file
+        :param triangles: a numpy array of triangles, shape (n, 3, 3)
+        :param normals: a numpy array of normals, shape (n, 3)
+        """
+        triangles = np.asarray(triangles, dtype=float).reshape(-1, 3, 3)
+        if normals is None:
+            normals = self.calc_normals(triangles)
+
+        if self.is_bin:
+            data = np.zeros(len(triangles), dtype=BIN_TRIANGLE_DTYPE)
+            data['normal'] = normals
+            data['vertices'] = triangles
+
+            # keep the chunks in order with anything already buffered by add_triangle
+            if self.writer is None:
+                self.f.write(data.tobytes())
+            else:
+                self.flush_buffer()
+                self.queue_chunk(data.tobytes())
+
+            self.num_triangles += len(triangles)
+        else:
+            for triangle, normal in zip(triangles, normals):
+                self.add_triangle(triangle, tuple(normal))
+
+
+    def add_quads(self, v1, v2, v3, v4):
+        """  Write an array of quadrilaterals to the STL file, split the same way as add_quad
+        :param v1, v2, v3, v4: numpy arrays of the corners of the quads, shape (n, 3)
+        """
+        self.add_triangles(quads_to_triangles(v1, v2, v3, v4))
+
+
     def length_vector(self, v):
         """ Return the length of a vector """
         return math.sqrt(v[0]**2 + v[1]**2 + v[2]**2)
@@ -144,6 +306,55 @@ class PySTL(object):
         return self.unit_vector((nx, ny, nz))
 
 
+    def calc_normals(self, triangles):
+        return calc_normals(triangles)
+
+
+class FacetBuffer(object):
+    """
+    Has the same add_ methods as PySTL, but keeps the triangles and their normals in memory instead of writing them,
+    so they can be written any number of times (e.g. moved to each copy of a part) without working out the normals
+    again
+    """
+    def __init__(self):
+        self.triangles = []
+        self.normals = []
+
+
+    def add_triangle(self, triangle, normal=None):
+        self.add_triangles(np.array(triangle, dtype=float).reshape(1, 3, 3),
+                           None if normal is None else np.array(normal, dtype=float).reshape(1, 3))
+
+
+    def add_quad(self, v1, v2, v3, v4):
+        self.add_triangle((v1, v2, v4))
+        self.add_triangle((v2, v3, v4))
+
+
+    def add_triangles(self, triangles, normals=None):
+        triangles = np.asarray(triangles, dtype=float).reshape(-1, 3, 3)
+        self.triangles.append(triangles)
+        self.normals.append(calc_normals(triangles) if normals is None else np.asarray(normals, dtype=float))
+
+
+    def add_quads(self, v1, v2, v3, v4):
+        self.add_triangles(quads_to_triangles(v1, v2, v3, v4))
+
+
+    def get_triangles(self):
+        """ Return all of the triangles added so far as an array of shape (n, 3, 3) """
+        if not self.triangles:
+            return np.zeros((0, 3, 3), dtype=float)
+        return np.concatenate(self.triangles)
+
+
+    def get_normals(self):
+        """ Return the normals of all of the triangles added so far as an array of shape (n, 3) """
+        if not self.normals:
+            return np.zeros((0, 3), dtype=float)
+        return np.concatenate(self.normals)
+
+
 if __name__ == '__main__':
     stl_name = 'bin_stl_test.stl'
     v1 = (0.0, 0.0, 0.5)
@@ -0,0 +1,398 @@
+"""
+Simplify - cut down the number of triangles of the wrap_image vertex grid
+
+Flat areas of the grid are merged into bigger blocks and busy areas keep the full resolution. The result is the
+triangles, as indices into the vertices, and the columns used by the end caps:
+
+    triangles, end_columns = simplify.simplify_mesh(vertices, 0.1)
+
+Each block is checked in the (column, row) space of the grid: the radius of every full resolution vertex in a block
+is compared with the radius at the same place on the block's triangles. How far a chord across the block falls inside
+the arc, and how far the triangles shift around the cylinder where the radius changes, are added on. Together they
+bound the distance from each vertex to a point on the simplified surface, so every full resolution vertex is within
+tolerance of the simplified surface. That's not the error along a ray from the axis, which can be bigger where the
+surface slopes steeply.
+"""
+
+import math
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+BATCH_RADII = 1 << 20  # number of radii checked at a time when simplifying the mesh
+
+
+def calc_radii(vertices):
+    # distance of each vertex from the axis of the cylinder
+    return np.hypot(vertices[:, :, 0], vertices[:, :, 1])
+
+
+def calc_chord_error(radius, rads):
+    # how far a chord spanning rads radians falls inside the arc (the sagitta)
+    return radius * (1.0 - math.cos(rads / 2.0))
+
+
+def calc_twist_error(windows, width):
+    """
+    Return how far the triangles of each block of windows, of shape (n, w+1, h+1), can move sideways from the vertices
+    on a grid width columns around. The triangles interpolate the positions of their corners, not their radii and
+    angles, so where the radius changes across a block the points on its triangles shift around the cylinder, by up
+    to a quarter of the change in radius times the angle the block spans.
+    """
+    _, size_u, _ = windows.shape
+    rads = (size_u - 1) * (math.pi * 2.0) / float(width)
+    return (windows.max(axis=(1, 2)) - windows.min(axis=(1, 2))) * (rads / 4.0)
+
+
+def calc_quad_error(windows, reverse_x=False):
+    """
+    Return the largest radial error between the radii in each block of windows, of shape (n, w+1, h+1), and the two
+    triangles between the corners of the block. The blocks are split along the same diagonal as
+    wrap_image.draw_cylinder.
+    """
+    n, size_u, size_v = windows.shape
+    u = (np.arange(size_u, dtype=float) / (size_u - 1))[:, np.newaxis]
+    v = (np.arange(size_v, dtype=float) / (size_v - 1))[np.newaxis, :]
+    r1 = windows[:, :1, :1]
+    r2 = windows[:, -1:, :1]
+    r3 = windows[:, -1:, -1:]
+    r4 = windows[:, :1, -1:]
+
+    if reverse_x:
+        interp = np.where(u >= v, r1 + u * (r2 - r1) + v * (r3 - r2), r1 + u * (r3 - r4) + v * (r4 - r1))
+    else:
+        interp = np.where(u + v <= 1.0, r1 + u * (r2 - r1) + v * (r4 - r1),
+                          r3 + (1.0 - u) * (r4 - r3) + (1.0 - v) * (r2 - r3))
+
+    return np.abs(windows - interp).max(axis=(1, 2))
+
+
+def calc_edge_loop(w, h):
+    # the positions around the edges of a w x h block, counter-clockwise from its bottom left corner
+    across = np.arange(w)
+    up = np.arange(h)
+    loop_i = np.concatenate((across, np.full(h, w), w - across, np.zeros(h, dtype=int)))
+    loop_j = np.concatenate((np.zeros(w, dtype=int), up, np.full(w, h), h - up))
+    return loop_i, loop_j
+
+
+def interpolate_edges(windows, on_edge, t):
+    """
+    Return the radii at positions t (floats) around the edges of each block of windows, of shape (n, w+1, h+1),
+    interpolated between the positions that are on_edge (shape (n, 2w + 2h), see calc_edge_loop)
+    """
+    n, size_u, size_v = windows.shape
+    perimeter = on_edge.shape[1]
+    loop_i, loop_j = calc_edge_loop(size_u - 1, size_v - 1)
+    loop_r = windows[:, loop_i, loop_j]
+    loop_r = np.concatenate((loop_r, loop_r[:, :1]), axis=1)
+
+    # the positions on_edge either side of each position
+    positions = np.arange(perimeter)
+    before = np.maximum.accumulate(np.where(on_edge, positions, 0), axis=1)
+    after = np.minimum.accumulate(np.where(on_edge, positions, perimeter)[:, ::-1], axis=1)[:, ::-1]
+    after = np.concatenate((after[:, 1:], np.full((n, 1), perimeter)), axis=1)
+
+    k = np.minimum(np.floor(t).astype(int), perimeter - 1)
+    a = before[:, k]
+    b = after[:, k]
+    r_a = np.take_along_axis(loop_r, a, axis=1)
+    r_b = np.take_along_axis(loop_r, b, axis=1)
+    return r_a + (t - a) / (b - a) * (r_b - r_a)
+
+
+def calc_edge_error(windows, on_edge):
+    """
+    Return the largest radial error around the edges of each block of windows, of shape (n, w+1, h+1), drawn with
+    edges from each position that is on_edge (see calc_edge_loop) to the next. A block one cell wide (or high) has no
+    other vertices.
+    """
+    n, size_u, size_v = windows.shape
+    loop_i, loop_j = calc_edge_loop(size_u - 1, size_v - 1)
+    interp = interpolate_edges(windows, on_edge, np.arange(len(loop_i), dtype=float))
+    return np.abs(windows[:, loop_i, loop_j] - interp).max(axis=1)
+
+
+def calc_fan_error(windows, on_edge):
+    """
+    Return the largest radial error between the radii in each block of windows, of shape (n, w+1, h+1), and the fan
+    of triangles from its center to the positions around its edges that are on_edge (shape (n, 2w + 2h), see
+    calc_edge_loop). Each vertex is on the line from the center through a point on the edge of the block, between two
+    of the fan's positions, so it's interpolated along the edge and then toward the center.
+    """
+    n, size_u, size_v = windows.shape
+    w, h = size_u - 1, size_v - 1
+    perimeter = 2 * (w + h)
+
+    # where the line from the center through each vertex meets the edge (t is the position around the edges), and
+    # how far along it the vertex is (reach)
+    du = (np.arange(size_u, dtype=float) - w / 2.0)[:, np.newaxis] * np.ones(size_v)
+    dv = (np.arange(size_v, dtype=float) - h / 2.0)[np.newaxis, :] * np.ones((size_u, 1))
+    nu = np.abs(du) / (w / 2.0)
+    nv = np.abs(dv) / (h / 2.0)
+    reach = np.maximum(nu, nv)
+    scale = np.where(reach > 0.0, reach, 1.0)
+    qu = w / 2.0 + du / scale
+    qv = h / 2.0 + dv / scale
+    t = np.select([(dv < 0.0) & (nv >= nu), (du > 0.0) & (nu >= nv), (dv > 0.0) & (nv >= nu)],
+                  [qu, w + qv, 2 * w + h - qu], perimeter - qv)
+    t = np.where(reach > 0.0, t % perimeter, 0.0).ravel()
+    reach = reach.ravel()
+
+    r_edge = interpolate_edges(windows, on_edge, t)
+    r_center = windows[:, w // 2, h // 2][:, np.newaxis]
+    interp = r_center + reach * (r_edge - r_center)
+
+    return np.abs(windows.reshape(n, -1) - interp).max(axis=1)
+
+
+def calc_block_limits(radii, tolerance):
+    # the radial error allowed for a block w columns wide, after the chord error across it
+    width, _ = radii.shape
+    radians_per_pixel = (math.pi * 2.0) / float(width)
+    max_radius = radii.max()
+    return lambda w: tolerance - calc_chord_error(max_radius, w * radians_per_pixel)
+
+
+def calc_block_windows(wrapped, w, h, i0, j0):
+    # the radii of the w x h blocks with their bottom left corners at (i0, j0), shape (n, w+1, h+1)
+    return sliding_window_view(wrapped, (w+1, h+1))[i0, j0]
+
+
+def merge_blocks(radii, tolerance, reverse_x=False):
+    """
+    Find where the cells of the vertex grid can be merged into bigger blocks. The blocks are 2**a columns by 2**b rows,
+    lined up on multiples of their size, and can be merged where either pair of halves could be and drawing the block
+    as two triangles stays within tolerance. Returns a dictionary of which blocks can be merged for each (w, h). No
+    block spans more than a quarter turn.
+    """
+    width, height = radii.shape
+    wrapped = np.vstack((radii, radii[:1]))
+    block_limit = calc_block_limits(radii, tolerance)
+    merged = {(1, 1): np.ones((width, height-1), dtype=bool)}
+    w = 1
+
+    while w <= max(1, width // 4) and block_limit(w) >= 0.0:
+        h = 1
+        while h <= height-1:
+            nw, nh = width // w, (height-1) // h
+            blocks = np.zeros((nw, nh), dtype=bool)
+
+            # the blocks whose left and right, or bottom and top, halves can be merged
+            if (w // 2, h) in merged:
+                halves = merged[(w // 2, h)]
+                blocks |= halves[0:2*nw:2, :nh] & halves[1:2*nw:2, :nh]
+            if (w, h // 2) in merged:
+                halves = merged[(w, h // 2)]
+                blocks |= halves[:nw, 0:2*nh:2] & halves[:nw, 1:2*nh:2]
+
+            if (w, h) != (1, 1):
+                # check the blocks in batches so the windows copied out of wrapped stay small
+                bi, bj = np.nonzero(blocks)
+                batch = max(1, BATCH_RADII // ((w+1) * (h+1)))
+                for k in range(0, len(bi), batch):
+                    i, j = bi[k:k+batch], bj[k:k+batch]
+                    windows = calc_block_windows(wrapped, w, h, i * w, j * h)
+                    limit = block_limit(w) - calc_twist_error(windows, width)
+                    blocks[i, j] = calc_quad_error(windows, reverse_x) <= limit
+                merged[(w, h)] = blocks
+            h *= 2
+        w *= 2
+
+    return merged
+
+
+def find_leaves(merged, width, height):
+    """
+    Cover the vertex grid with the biggest blocks that can be merged, from merge_blocks, without overlapping. Returns a
+    dictionary of the (i, j) corners of the blocks of each (w, h).
+    """
+    covered = np.zeros((width, height-1), dtype=bool)
+    leaves = {}
+
+    for w, h in sorted(merged, key=lambda shape: (shape[0] * shape[1], shape[1]), reverse=True):
+        blocks = merged[(w, h)]
+        nw, nh = blocks.shape
+        blocks = blocks & ~covered[:nw * w, :nh * h].reshape(nw, w, nh, h).any(axis=(1, 3))
+        bi, bj = np.nonzero(blocks)
+        leaves[(w, h)] = (bi * w, bj * h)
+        covered[:nw * w, :nh * h] |= np.repeat(np.repeat(blocks, w, axis=0), h, axis=1)
+
+    return leaves
+
+
+def find_corners(leaves, width, height):
+    """
+    Return which vertices are a corner of a block, with the seam (column width) the same as column 0. The first and
+    last rows use the same columns, so the end caps and the hole line up.
+    """
+    corners = np.zeros((width+1, height), dtype=bool)
+    for (w, h), (i0, j0) in leaves.items():
+        for di in (0, w):
+            for dj in (0, h):
+                corners[i0 + di, j0 + dj] = True
+
+    corners[0] |= corners[width]
+    end_columns = corners[:, 0] | corners[:, height-1]
+    corners[:, 0] = end_columns
+    corners[:, height-1] = end_columns
+    corners[width] = corners[0]
+    return corners
+
+
+def find_edge_corners(corners, w, h, i0, j0):
+    # which positions around the edges of each block (see calc_edge_loop) are corners of any block
+    loop_i, loop_j = calc_edge_loop(w, h)
+    return corners[i0[:, np.newaxis] + loop_i, j0[:, np.newaxis] + loop_j]
+
+
+def find_bad_leaves(corners, wrapped, limit, w, h, i0, j0, reverse_x=False):
+    # which of the w x h blocks at (i0, j0) are out of tolerance as they will be drawn (see triangulate_leaves)
+    windows = calc_block_windows(wrapped, w, h, i0, j0)
+    limit = limit - calc_twist_error(windows, len(wrapped) - 1)
+    on_edge = find_edge_corners(corners, w, h, i0, j0)
+    is_fan = on_edge.sum(axis=1) > 4
+    bad = np.zeros(len(i0), dtype=bool)
+    bad[~is_fan] = calc_quad_error(windows[~is_fan], reverse_x) > limit[~is_fan]
+    if w == 1 or h == 1:
+        bad[is_fan] = calc_edge_error(windows[is_fan], on_edge[is_fan]) > limit[is_fan]
+    elif is_fan.any():
+        bad[is_fan] = calc_fan_error(windows[is_fan], on_edge[is_fan]) > limit[is_fan]
+    return bad
+
+
+def split_leaves(leaves, corners, wrapped, block_limit, reverse_x=False):
+    """
+    Split the blocks that are out of tolerance as they will be drawn (see triangulate_leaves) in half across their
+    longer side. Returns True if any blocks were split.
+    """
+    split = False
+
+    # biggest first, so the halves of a block are checked in the same pass
+    for w, h in sorted(leaves, key=lambda shape: shape[0] * shape[1], reverse=True):
+        i0, j0 = leaves[(w, h)]
+        if (w, h) == (1, 1) or len(i0) == 0:
+            continue
+
+        batch = max(1, BATCH_RADII // ((w+1) * (h+1)))
+        bad = np.concatenate([find_bad_leaves(corners, wrapped, block_limit(w), w, h, i0[k:k+batch], j0[k:k+batch],
+                                              reverse_x) for k in range(0, len(i0), batch)])
+        if not bad.any():
+            continue
+
+        # split the bad blocks into two halves
+        if w >= h:
+            half, offset = (w // 2, h), (w // 2, 0)
+        else:
+            half, offset = (w, h // 2), (0, h // 2)
+        hi, hj = leaves.get(half, (np.zeros(0, dtype=int), np.zeros(0, dtype=int)))
+        leaves[half] = (np.concatenate((hi, i0[bad], i0[bad] + offset[0])),
+                        np.concatenate((hj, j0[bad], j0[bad] + offset[1])))
+        leaves[(w, h)] = (i0[~bad], j0[~bad])
+        split = True
+
+    return split
+
+
+def zip_strips(corners, w, h, i0, j0):
+    """
+    Return the triangles, as (i, j) corners of shape (n, 3, 2), joining the long edges of blocks one cell wide (or
+    high) through every corner of a block on them. The triangles go counter-clockwise.
+    """
+    # the two long edges of each block, along its length
+    length = max(w, h)
+    along = np.arange(length + 1)
+    if w == 1:
+        edge_i = np.stack((np.zeros(length + 1, dtype=int), np.ones(length + 1, dtype=int)), axis=1)
+        edge_j = np.stack((along, along), axis=1)
+    else:
+        edge_i = np.stack((along, along), axis=1)
+        edge_j = np.stack((np.zeros(length + 1, dtype=int), np.ones(length + 1, dtype=int)), axis=1)
+    on_edge = corners[i0[:, np.newaxis, np.newaxis] + edge_i, j0[:, np.newaxis, np.newaxis] + edge_j]
+
+    # walk up both edges at once, adding a triangle from the last corner on each edge to each corner after the first
+    # two (the corners at the start of the block)
+    block, k, side = np.nonzero(on_edge)
+    steps = np.arange(len(block))
+    last_on = [np.maximum.accumulate(np.where(side == s, steps, 0)) for s in (0, 1)]
+    first = np.searchsorted(block, block, side='left')
+    keep = steps - first >= 2
+    step, prev = steps[keep], steps[keep] - 1
+    p1 = np.stack((i0[block] + edge_i[k, side], j0[block] + edge_j[k, side]), axis=1)
+    triangles = np.stack((p1[last_on[0][prev]], p1[last_on[1][prev]], p1[step]), axis=1)
+
+    # walking along the bottom and top edges of a wide block goes clockwise
+    return triangles if w == 1 else triangles[:, ::-1]
+
+
+def triangulate_leaves(leaves, corners, height, reverse_x=False):
+    """
+    Return the triangles of the blocks as indices into the (width * height) vertices, shape (n, 3). A block with only
+    its own four corners on its edges is drawn as a quad, split the same way as wrap_image.draw_cylinder. Any other
+    corners on its edges (from smaller blocks next to it) would leave T-junctions, so the block is drawn as a fan from
+    its center to every corner around its edges instead, or for a block one cell wide (or high), by zipping its long
+    edges together.
+    """
+    width = corners.shape[0] - 1
+    triangles = []
+
+    def index(i, j):
+        return (i % width) * height + j
+
+    for (w, h), (i0, j0) in sorted(leaves.items(), reverse=True):
+        on_edge = find_edge_corners(corners, w, h, i0, j0)
+        is_quad = on_edge.sum(axis=1) == 4
+
+        v1 = index(i0[is_quad], j0[is_quad])
+        v2 = index(i0[is_quad] + w, j0[is_quad])
+        v3 = index(i0[is_quad] + w, j0[is_quad] + h)
+        v4 = index(i0[is_quad], j0[is_quad] + h)
+        if reverse_x:
+            v1, v2, v3, v4 = v4, v3, v2, v1
+        triangles.append(np.stack((np.stack((v1, v2, v4), axis=1), np.stack((v2, v3, v4), axis=1)), axis=1)
+                         .reshape(-1, 3))
+
+        if is_quad.all():
+            continue
+        elif w == 1 or h == 1:
+            strips = zip_strips(corners, w, h, i0[~is_quad], j0[~is_quad])
+            joined = index(strips[:, :, 0], strips[:, :, 1])
+        else:
+            # fan from the center of each block to each corner on its edges and on to the next one around
+            block, pos = np.nonzero(on_edge[~is_quad])
+            first = np.searchsorted(block, block, side='left')
+            last = np.searchsorted(block, block, side='right') - 1
+            following = np.where(np.arange(len(block)) == last, first, np.arange(len(block)) + 1)
+
+            loop_i, loop_j = calc_edge_loop(w, h)
+            fi, fj = i0[~is_quad][block], j0[~is_quad][block]
+            center = index(fi + w // 2, fj + h // 2)
+            p1 = index(fi + loop_i[pos], fj + loop_j[pos])
+            p2 = index(fi + loop_i[pos[following]], fj + loop_j[pos[following]])
+            joined = np.stack((center, p1, p2), axis=1)
+
+        triangles.append(joined[:, ::-1] if reverse_x else joined)
+
+    return np.concatenate(triangles)
+
+
+def simplify_mesh(vertices, tolerance, reverse_x=False):
+    """
+    Return a mesh of the vertices where every full resolution vertex is within tolerance (in mm) of the simplified
+    surface (see above), as the triangles (indices into vertices.reshape(-1, 3), shape (n, 3)) and the columns of the
+    vertices used by the end caps. Flat areas are drawn with big blocks and busy areas keep the full resolution (see
+    merge_blocks). Blocks are split until they are within tolerance as drawn, including the fans that join them to
+    smaller neighbours. The blocks wrap around the seam, and the first and last rows use the same columns so the end
+    caps and the hole line up.
+    """
+    width, height, _ = vertices.shape
+    radii = calc_radii(vertices)
+    wrapped = np.vstack((radii, radii[:1]))
+    block_limit = calc_block_limits(radii, tolerance)
+    leaves = find_leaves(merge_blocks(radii, tolerance, reverse_x), width, height)
+
+    corners = find_corners(leaves, width, height)
+    while split_leaves(leaves, corners, wrapped, block_limit, reverse_x):
+        corners = find_corners(leaves, width, height)
+
+    return triangulate_leaves(leaves, corners, height, reverse_x), np.nonzero(corners[:width, 0])[0]
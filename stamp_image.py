@@ -16,6 +16,12 @@ Create a 3D object of a height field of an image  on the face of a cylinder.
             --roundness - roundness of the cylinder (int)
             --z_height - height of the cylinder for the stamp
             --stl_type - STL file type - text or bin (default bin)
+            --copies - Number of copies of each image on the sheet (int)
+            --columns - Number of stamps across the sheet (int - 0 for as square as possible)
+            --spacing - Space between the stamps on the sheet (float)
+            --plan - Print the number of facets, file size and memory needed as JSON without creating the STL file
+            --preview - Save a shaded preview image of the stamp face to this file instead of creating the STL file
+            --preview_size - Maximum width and height of the preview image (int)
 
         The options are somewhat confusing as the stamp goes on the bottom (Z=0.0) so by default the stamp goes from
         image_low of 0.0 to image_high of -4.0 (4 mm below the bottom).
@@ -49,19 +55,27 @@ Create a 3D object of a height field of an image  on the face of a cylinder.
 
         python stamp_image.py -i test_image.png --margin=5.0 --image_low=0.0 --image_high=10.0 -o stamp.stl -or=70.0 -z=40.0 --roundness=4 --invert_image=true
 
+        -or- a sheet of stamps, with two copies each of two images, in one STL file:
+
+        python stamp_image.py -i test_image.png freize1.jpg --copies=2 --spacing=10.0 -o stamps.stl
+
 Len Wanger
 last updated: 2018
 
 """
 
 import argparse
+import json
 import numpy as np
 import math
 from PIL import Image
+import preview
 import pystl
 import sys
 
-from utils import Vertex3, Triangle
+from utils import background_iter, disc_triangles, disc_with_rect_hole_triangles, ring_quads, tube_triangles
+
+CHUNK_COLUMNS = 64  # number of columns of pixels drawn at a time
 
 
 def calc_max_xy(im_width, im_height, outer_radius, margin_pct):
@@ -73,6 +87,21 @@ def calc_max_xy(im_width, im_height, outer_radius, margin_pct):
     return max_x, max_y
 
 
+def calc_stamp_heights(im, low_z, high_z, mirror_image=False, invert_image=False):
+    """ Return the z value of each pixel of the stamp, indexed [x][y] and calculated the same way as calc_stamp_vertices """
+    pixels = np.asarray(im, dtype=float).T
+
+    if mirror_image is True:
+        pixels = pixels[::-1]
+
+    if invert_image is True:
+        z_a = (255.0 - pixels) / 255.0
+    else:
+        z_a = pixels / 255.0
+
+    return ((high_z - low_z) * z_a) + low_z
+
+
 def calc_stamp_vertices(im, outer_radius, margin_pct, low_z, high_z, mirror_image=False, invert_image=False):
     """
     center of image is at (0,0)
@@ -82,69 +111,66 @@ def calc_stamp_vertices(im, outer_radius, margin_pct, low_z, high_z, mirror_imag
     The margin is based on the hypotenus of the triangle from the origin to (im_width,0( and (im_width, im_height).
     """
     im_width, im_height = im.width, im.height
-    vertices = np.zeros((im_width, im_height, 3), dtype=float)
+    vertices = np.empty((im_width, im_height, 3), dtype=float)
     max_x, max_y = calc_max_xy(im_width, im_height, outer_radius, margin_pct)
 
     min_x = -max_x
     min_y = -max_y
     wm1 = im_width - 1
     hm1 = im_height - 1
-    delta_z = high_z - low_z
     delta_x = max_x - min_x
     delta_y = max_y - min_y
 
-    for i in range(im_width):
-        for j in range(im_height):
-            i_idx = i if mirror_image == False else wm1-i
-            x = (delta_x * (i / wm1)) + min_x
-            y = (delta_y * (j / hm1)) + min_y
-            pixel_val = im.getpixel((i_idx, j))
+    vertices[:, :, 0] = ((delta_x * (np.arange(im_width) / wm1)) + min_x)[:, np.newaxis]
+    vertices[:, :, 1] = (delta_y * (np.arange(im_height) / hm1)) + min_y
+    vertices[:, :, 2] = calc_stamp_heights(im, low_z, high_z, mirror_image, invert_image)
+    return vertices
 
-            if invert_image is True:
-                z_a = (255.0 - pixel_val) / 255.0
-            else:
-                z_a = pixel_val / 255.0
 
-            z = (delta_z * z_a) + low_z # lerp(cap_z, high_z, z_a)
-            vertices[i][j] = (x, y, z)
+def iter_stamp_triangles(vertices, reverse_direction=False, chunk_size=CHUNK_COLUMNS):
+    """
+    Yield the triangles of a quad for each pixel at its z value, plus sidewalls to the next pixel over and down where
+    the z value changes. The triangles are yielded a chunk of columns at a time, in the same order as pixel by pixel.
+    """
+    width, height, _ = vertices.shape
 
-    return vertices
+    def corners(xy, z):
+        return np.concatenate((xy, z[:, :, np.newaxis]), axis=2)
 
+    for start in range(0, width-1, chunk_size):
+        stop = min(start + chunk_size, width-1)
+        p = vertices[start:stop+1]
+        z = p[:-1, :-1, 2]
+        z_next_x = p[1:, :-1, 2]
+        z_next_y = p[:-1, 1:, 2]
 
-def draw_stamp(stl, vertices, reverse_direction=False):
-    width, height, _ = vertices.shape
+        p1 = p[:-1, :-1, :2]
+        p2 = p[1:, :-1, :2]
+        p3 = p[1:, 1:, :2]
+        p4 = p[:-1, 1:, :2]
 
-    for i in range(width-1):
-        for j in range(height-1):
-            z = vertices[i][j][2]
-            z_next_x = vertices[i+1][j][2]
-            z_next_y = vertices[i][j+1][2]
-
-            v1 = (vertices[i][j][0], vertices[i][j][1], z)
-            v2 = (vertices[i+1][j][0], vertices[i+1][j][1], z)
-            v3 = (vertices[i+1][j+1][0], vertices[i+1][j+1][1], z)
-            v4 = (vertices[i][j+1][0], vertices[i][j+1][1], z)
-
-            if reverse_direction:
-                stl.add_quad(v1, v2, v3, v4)
-            else:
-                stl.add_quad(v4, v3, v2, v1)
-
-            # draw sidewall to next pixel over
-            if z != z_next_x:
-                v1 = (vertices[i+1][j][0], vertices[i+1][j][1], z)
-                v2 = (vertices[i+1][j][0], vertices[i+1][j][1], z_next_x)
-                v3 = (vertices[i+1][j+1][0], vertices[i+1][j+1][1], z_next_x)
-                v4 = (vertices[i+1][j+1][0], vertices[i+1][j+1][1], z)
-                stl.add_quad(v4, v3, v2, v1)
-
-            # draw sidewall to next pixel down
-            if z != z_next_y:
-                v1 = (vertices[i][j+1][0], vertices[i][j+1][1], z)
-                v2 = (vertices[i+1][j+1][0], vertices[i+1][j+1][1], z)
-                v3 = (vertices[i+1][j+1][0], vertices[i+1][j+1][1], z_next_y)
-                v4 = (vertices[i][j+1][0], vertices[i][j+1][1], z_next_y)
-                stl.add_quad(v4, v3, v2, v1)
+        # the pixel, the sidewall to the next pixel over and the sidewall to the next pixel down for each pixel
+        quads = np.stack((
+            np.stack((corners(p1, z), corners(p2, z), corners(p3, z), corners(p4, z)), axis=2),
+            np.stack((corners(p2, z), corners(p2, z_next_x), corners(p3, z_next_x), corners(p3, z)), axis=2),
+            np.stack((corners(p4, z), corners(p3, z), corners(p3, z_next_y), corners(p4, z_next_y)), axis=2),
+        ), axis=2)
+        mask = np.stack((np.ones_like(z, dtype=bool), z != z_next_x, z != z_next_y), axis=2)
+        quads = quads[mask]
+
+        if reverse_direction:
+            # only the pixel quads are reversed
+            is_pixel = np.stack((np.ones_like(z, dtype=bool), np.zeros_like(z, dtype=bool),
+                                 np.zeros_like(z, dtype=bool)), axis=2)[mask]
+            quads[is_pixel] = quads[is_pixel][:, ::-1]
+
+        yield pystl.quads_to_triangles(quads[:, 3], quads[:, 2], quads[:, 1], quads[:, 0]).reshape(-1, 3, 3)
+
+
+def draw_stamp(stl, vertices, reverse_direction=False, chunk_size=CHUNK_COLUMNS):
+    # draw the face of the stamp a chunk of columns at a time - see iter_stamp_triangles
+    for triangles in iter_stamp_triangles(vertices, reverse_direction, chunk_size):
+        stl.add_triangles(triangles)
 
 
 def draw_margin(stl, im, radius, margin_pct, z, segments=20):
@@ -153,181 +179,221 @@ def draw_margin(stl, im, radius, margin_pct, z, segments=20):
     it's a little confusing. It's drawn as quandrants (segments/4) pieces. The first and the last segments of
     the quadrant are drawn as quads to the corner and halfway along the closest edge. The rest as triangles.
     """
-    max_x, max_y = calc_max_xy(im.width, im.height, outer_radius, margin_pct)
-    qtr_segments = segments // 4
-    pi2 = math.pi * 2.0
-
-    # draw 1st quadrant
-    for i in range(qtr_segments):
-        start = (i / segments) * pi2
-        stop = ((i+1) / segments) * pi2
-        start_x = math.cos(start) * radius
-        start_y = math.sin(start) * radius
-        stop_x = math.cos(stop) * radius
-        stop_y = math.sin(stop) * radius
-        v1 = Vertex3(start_x, start_y, z)
-        v2 = Vertex3(stop_x, stop_y, z)
-
-        if i==0:    # draw a quad to corner
-            v3 = Vertex3(max_x, max_y, z)
-            v4 = Vertex3(max_x, 0.0, z)
-            stl.add_quad(v4,v3,v2,v1)
-        elif i == (qtr_segments-1):
-            v3 = Vertex3(0.0, max_y, z)
-            v4 = Vertex3(max_x, max_y, z)
-            stl.add_quad(v4,v3,v2,v1)
-        else:
-            v3 = Vertex3(max_x, max_y, z)
-            tri = Triangle(v3, v2, v1)
-            stl.add_triangle(tri)
-
-    # draw 2nd quadrant
-    for i in range(qtr_segments, 2*qtr_segments):
-        start = (i / segments) * pi2
-        stop = ((i + 1) / segments) * pi2
-        start_x = math.cos(start) * radius
-        start_y = math.sin(start) * radius
-        stop_x = math.cos(stop) * radius
-        stop_y = math.sin(stop) * radius
-        v1 = Vertex3(start_x, start_y, z)
-        v2 = Vertex3(stop_x, stop_y, z)
-
-        if i==qtr_segments:    # draw a quad to corner
-            v3 = Vertex3(-max_x, max_y, z)
-            v4 = Vertex3(0.0, max_y, z)
-            stl.add_quad(v4,v3,v2,v1)
-        elif i == (2*qtr_segments-1):
-            v3 = Vertex3(-max_x, 0.0, z)
-            v4 = Vertex3(-max_x, max_y, z)
-            stl.add_quad(v4,v3,v2,v1)
-        else:
-            v3 = Vertex3(-max_x, max_y, z)
-            tri = Triangle(v3, v2, v1)
-            stl.add_triangle(tri)
-
-    # draw 3rd quadrant
-    for i in range(2*qtr_segments, 3*qtr_segments):
-        start = (i / segments) * pi2
-        stop = ((i + 1) / segments) * pi2
-        start_x = math.cos(start) * radius
-        start_y = math.sin(start) * radius
-        stop_x = math.cos(stop) * radius
-        stop_y = math.sin(stop) * radius
-        v1 = Vertex3(start_x, start_y, z)
-        v2 = Vertex3(stop_x, stop_y, z)
-
-        if i==2*qtr_segments:    # draw a quad to corner
-            v3 = Vertex3(-max_x, -max_y, z)
-            v4 = Vertex3(-max_x, 0.0, z)
-            stl.add_quad(v4,v3,v2,v1)
-        elif i == (3*qtr_segments-1):
-            v3 = Vertex3(0.0, -max_y, z)
-            v4 = Vertex3(-max_x, -max_y, z)
-            stl.add_quad(v4,v3,v2,v1)
-        else:
-            v3 = Vertex3(-max_x, -max_y, z)
-            tri = Triangle(v3, v2, v1)
-            stl.add_triangle(tri)
-
-    for i in range(3*qtr_segments, segments):
-        start = (i / segments) * pi2
-        stop = ((i + 1) / segments) * pi2
-        start_x = math.cos(start) * radius
-        start_y = math.sin(start) * radius
-        stop_x = math.cos(stop) * radius
-        stop_y = math.sin(stop) * radius
-        v1 = Vertex3(start_x, start_y, z)
-        v2 = Vertex3(stop_x, stop_y, z)
-
-        if i==3*qtr_segments:    # draw a quad to corner
-            v3 = Vertex3(max_x, -max_y, z)
-            v4 = Vertex3(0.0, -max_y, z)
-            stl.add_quad(v4,v3,v2,v1)
-        elif i == (segments-1):
-            v3 = Vertex3(max_x, 0.0, z)
-            v4 = Vertex3(max_x, -max_y, z)
-            stl.add_quad(v4,v3,v2,v1)
-        else:
-            v3 = Vertex3(max_x, -max_y, z)
-            tri = Triangle(v3, v2, v1)
-            stl.add_triangle(tri)
+    max_x, max_y = calc_max_xy(im.width, im.height, radius, margin_pct)
+    stl.add_triangles(disc_with_rect_hole_triangles(radius, segments, z, max_x, max_y))
 
 
 def draw_hollow_cylinder(stl, radius, bottom_z, top_z, segments=20):
-    pi2 = math.pi * 2.0
-    for i in range(segments):
-        start = (i / segments) * pi2
-        stop = ((i+1) / segments) * pi2
-
-        start_x = math.cos(start) * radius
-        start_y = math.sin(start) * radius
-        stop_x = math.cos(stop) * radius
-        stop_y = math.sin(stop) * radius
-
-        v1 = Vertex3(start_x, start_y, bottom_z)
-        v2 = Vertex3(stop_x, stop_y, bottom_z)
-        v3 = Vertex3(stop_x, stop_y, top_z)
-        v4 = Vertex3(start_x, start_y, top_z)
-        stl.add_quad(v1, v2, v3, v4)
+    stl.add_triangles(tube_triangles(radius, segments, bottom_z, top_z))
 
 
 def draw_cylinder_cap(stl, radius, z, segments=20):
     # Draw the cap of the cylinder. cemtered at (0,0)
-    pi2 = math.pi * 2.0
-    for i in range(segments):
-        start = (i / segments) * pi2
-        stop = ((i + 1) / segments) * pi2
-        start_x = math.cos(start) * radius
-        start_y = math.sin(start) * radius
-        stop_x = math.cos(stop) * radius
-        stop_y = math.sin(stop) * radius
-        v1 = Vertex3(start_x, start_y, z)
-        v2 = Vertex3(stop_x, stop_y, z)
-        v3 = Vertex3(0.0, 0.0, z)
-        tri = Triangle(v1, v2, v3)
-        stl.add_triangle(tri)
+    stl.add_triangles(disc_triangles(radius, segments, z))
 
 
 def draw_sidewalls(stl, vertices, outer_radius, margin_pct, z):
     # draw walls from the edges of the image to the stamp plane (bottom or top)
-    width, height = im.width, im.height
+    width, height, _ = vertices.shape
     max_x, max_y = calc_max_xy(width, height, outer_radius, margin_pct)
 
-    wm1 = width - 1
-    hm1 = height - 1
+    def wall(x, y, edge_z):
+        # the vertices along an edge at the stamp plane and at the height of the image
+        bottom = np.column_stack((np.broadcast_to(x, edge_z.shape), np.broadcast_to(y, edge_z.shape),
+                                  np.full(edge_z.shape, z, dtype=float)))
+        top = bottom.copy()
+        top[:, 2] = edge_z
+        return bottom, top
+
+    # the walls on opposite edges are drawn in pairs, a quad from each at a time
+    bottom, top = wall(vertices[:, 0, 0], -max_y, vertices[:, 0, 2])
+    near = ring_quads(top, bottom)
+    bottom, top = wall(vertices[:, -1, 0], max_y, vertices[:, -1, 2])
+    far = ring_quads(bottom, top)
+    stl.add_triangles(np.stack((near.reshape(-1, 2, 3, 3), far.reshape(-1, 2, 3, 3)), axis=1))
+
+    bottom, top = wall(-max_x, vertices[0, :, 1], vertices[0, :, 2])
+    near = ring_quads(bottom, top)
+    bottom, top = wall(max_x, vertices[-1, :, 1], vertices[-1, :, 2])
+    far = ring_quads(top, bottom)
+    stl.add_triangles(np.stack((near.reshape(-1, 2, 3, 3), far.reshape(-1, 2, 3, 3)), axis=1))
+
+
+def calc_sheet_offsets(num_stamps, columns, pitch):
+    """
+    Return the (x, y, z) offset of each stamp on a sheet. The stamps are laid out in rows of columns stamps, pitch
+    apart, left to right and top to bottom, with the sheet centered at (0,0).
+    """
+    columns = min(columns, num_stamps)
+    rows = (num_stamps + columns - 1) // columns
+    offsets = []
+
+    for k in range(num_stamps):
+        row, col = divmod(k, columns)
+        offsets.append(((col - (columns-1) / 2.0) * pitch, ((rows-1) / 2.0 - row) * pitch, 0.0))
+
+    return offsets
+
+
+def draw_sheet(stl, images, outer_radius, margin_pct, low_z, high_z, z_height, segments=20, mirror_image=False,
+               invert_image=False, copies=1, columns=None, spacing=5.0):
+    """
+    Draw copies of each image as stamps laid out on a grid, spacing apart. None of the cylinder depends on the image,
+    so it's drawn once and the same triangles are moved to each stamp. The same goes for the margin of each image
+    size and the sidewalls of each image. The face of each image is also only drawn once, a chunk of columns at a
+    time, and each chunk is moved to every copy of the stamp as it's drawn. Moving the triangles doesn't change their
+    normals, so they're only worked out once too.
+    """
+    num_stamps = len(images) * copies
+    if columns is None:
+        columns = int(math.ceil(math.sqrt(num_stamps)))
+    offsets = iter(calc_sheet_offsets(num_stamps, columns, 2.0 * outer_radius + spacing))
+
+    cylinder = pystl.FacetBuffer()
+    draw_hollow_cylinder(cylinder, outer_radius, 0.0, top_z=z_height, segments=segments)
+    draw_cylinder_cap(cylinder, outer_radius, z_height, segments=segments)
+    cylinder = cylinder.get_triangles(), cylinder.get_normals()
+    margins = {}
 
-    for x in range(wm1):
-        v1 = Vertex3(vertices[x][0][0], -max_y, z)
-        v2 = Vertex3(vertices[x+1][0][0], -max_y, z)
-        v3 = Vertex3(vertices[x+1][0][0], -max_y, vertices[x+1][0][2])
-        v4 = Vertex3(vertices[x][0][0], -max_y, vertices[x][0][2])
-        stl.add_quad(v4, v3, v2, v1)
+    for im in images:
+        if im.size not in margins:
+            margin = pystl.FacetBuffer()
+            draw_margin(margin, im, outer_radius, margin_pct, 0.0, segments=segments)
+            margins[im.size] = margin.get_triangles(), margin.get_normals()
 
-        v1 = Vertex3(vertices[x][hm1][0], max_y, z)
-        v2 = Vertex3(vertices[x+1][hm1][0], max_y, z)
-        v3 = Vertex3(vertices[x+1][hm1][0], max_y, vertices[x+1][hm1][2])
-        v4 = Vertex3(vertices[x][hm1][0], max_y, vertices[x][hm1][2])
-        stl.add_quad(v1, v2, v3, v4)
+        vertices = calc_stamp_vertices(im, outer_radius, margin_pct, low_z, high_z, mirror_image, invert_image)
+        sidewalls = pystl.FacetBuffer()
+        draw_sidewalls(sidewalls, vertices, outer_radius, margin_pct, 0.0)
+        sidewalls = sidewalls.get_triangles(), sidewalls.get_normals()
 
-    for y in range(hm1):
-        v1 = Vertex3(-max_x, vertices[0][y][1], z)
-        v2 = Vertex3(-max_x, vertices[0][y+1][1], z)
-        v3 = Vertex3(-max_x, vertices[0][y+1][1], vertices[0][y+1][2])
-        v4 = Vertex3(-max_x, vertices[0][y][1], vertices[0][y][2])
-        stl.add_quad(v1, v2, v3, v4)
+        copy_offsets = [next(offsets) for _ in range(copies)]
 
-        v1 = Vertex3(max_x, vertices[wm1][y][1], z)
-        v2 = Vertex3(max_x, vertices[wm1][y + 1][1], z)
-        v3 = Vertex3(max_x, vertices[wm1][y + 1][1], vertices[wm1][y + 1][2])
-        v4 = Vertex3(max_x, vertices[wm1][y][1], vertices[wm1][y][2])
-        stl.add_quad(v4, v3, v2, v1)
+        for triangles in iter_stamp_triangles(vertices):
+            normals = pystl.calc_normals(triangles)
+            for offset in copy_offsets:
+                stl.add_triangles(triangles + offset, normals)
+
+        for offset in copy_offsets:
+            for triangles, normals in (margins[im.size], sidewalls, cylinder):
+                stl.add_triangles(triangles + offset, normals)
+
+
+def iter_stamp_images(image_names):
+    """ Decode each image, yielding the number of bands in the original image and the greyscale image """
+    for image_name in image_names:
+        im_file = Image.open(image_name)
+        yield len(im_file.getbands()), im_file.convert('L')
+
+
+def calc_num_margin_facets(segments):
+    # each quadrant of draw_margin draws quads for its first and last segments and triangles in between
+    qtr_segments = segments // 4
+    num_facets = 0
+
+    for num_segments in (qtr_segments, qtr_segments, qtr_segments, segments - 3*qtr_segments):
+        if num_segments == 1:
+            num_facets += 2
+        elif num_segments > 1:
+            num_facets += num_segments + 2
+
+    return num_facets
+
+
+def calc_column_facets(heights):
+    """ Return the number of facets draw_stamp draws for each column of pixels of a stamp with the z values in heights """
+    width, height = heights.shape
+    z = heights[:-1, :-1]
+    x_walls = np.count_nonzero(z != heights[1:, :-1], axis=1)
+    y_walls = np.count_nonzero(z != heights[:-1, 1:], axis=1)
+    return 2 * (height-1) + 2 * (x_walls + y_walls)
+
+
+def calc_num_facets(heights, segments):
+    """ Return the number of facets drawn for each part of a stamp with the z values in heights """
+    width, height = heights.shape
+
+    return {
+        'stamp': int(calc_column_facets(heights).sum()),
+        'margin': calc_num_margin_facets(segments),
+        'sidewalls': 4 * (width-1) + 4 * (height-1),
+        'cylinder': 2 * segments,
+        'cap': segments,
+    }
+
+
+def calc_draw_memory(heights, chunk_size=CHUNK_COLUMNS, queue_size=pystl.QUEUE_SIZE):
+    """
+    Return an estimate of the memory used while the face of a stamp is drawn and written, for its largest chunk of
+    columns (see iter_stamp_triangles and draw_sheet), worked out from the sizes of the float64 arrays. Up to
+    queue_size packed chunks, and the one being written, wait for the writer thread.
+    """
+    width, height = heights.shape
+    column_facets = calc_column_facets(heights)
+    chunk_facets = int(np.add.reduceat(column_facets, np.arange(0, width-1, chunk_size)).max())
+    chunk_pixels = min(chunk_size, width-1) * (height-1)
+
+    # a quad (four corners), a triangle and a normal. Each quad kept is two facets
+    quad_bytes, triangle_bytes, normal_bytes = 4 * 3 * 8, 3 * 3 * 8, 3 * 8
+    kept_quad_bytes = quad_bytes // 2
+
+    # every pixel has three quads (the pixel and two sidewalls), stacked in threes and then all together, so there
+    # are two copies at once. The quads kept from the chunk before, and its triangles, are still around
+    stacking = 2 * 3 * quad_bytes * chunk_pixels + (kept_quad_bytes + triangle_bytes) * chunk_facets
+    # working out the normals of the chunk (see pystl.ADD_TRIANGLES_FACET_BYTES) while its quads are kept
+    normals = (kept_quad_bytes + pystl.ADD_TRIANGLES_FACET_BYTES) * chunk_facets
+    # moving the chunk to a stamp, with its quads, triangles and normals kept, then packing it and copying the packed
+    # bytes for the writer
+    moving = (kept_quad_bytes + 2 * triangle_bytes + normal_bytes + 2 * pystl.BIN_TRIANGLE_SIZE) * chunk_facets
+
+    drawing = max(stacking, normals, moving)
+    return drawing + (queue_size + 1) * pystl.BIN_TRIANGLE_SIZE * chunk_facets
+
+
+def plan_stamp(heights, segments, im_bands=1):
+    """
+    Return the number of facets, the size of the (binary) STL file and an estimate of the peak memory for a stamp,
+    without creating any geometry. The memory estimate covers the decoded image, its greyscale copy, the heights,
+    the vertex array and drawing the face a chunk at a time (see calc_draw_memory).
+    """
+    width, height = heights.shape
+    num_pixels = width * height
+    facets = calc_num_facets(heights, segments)
+    num_facets = sum(facets.values())
+    image_memory = num_pixels * (im_bands + 1) + num_pixels * 8 + num_pixels * 3 * 8
+
+    return {
+        'image': {'width': width, 'height': height},
+        'facets': facets,
+        'num_facets': num_facets,
+        'file_size': pystl.calc_bin_file_size(num_facets),
+        'peak_memory': image_memory + calc_draw_memory(heights),
+    }
+
+
+def plan_sheet(stamp_plans, copies=1):
+    """
+    Return the number of facets, the size of the (binary) STL file and an estimate of the peak memory for a sheet
+    of copies of each stamp in stamp_plans (from plan_stamp). The greyscale images are all kept until the end, but
+    only one stamp is drawn at a time.
+    """
+    num_facets = copies * sum(stamp_plan['num_facets'] for stamp_plan in stamp_plans)
+    num_pixels = sum(stamp_plan['image']['width'] * stamp_plan['image']['height'] for stamp_plan in stamp_plans)
+
+    return {
+        'stamps': stamp_plans,
+        'copies': copies,
+        'num_stamps': copies * len(stamp_plans),
+        'num_facets': num_facets,
+        'file_size': pystl.calc_bin_file_size(num_facets),
+        'peak_memory': num_pixels + max(stamp_plan['peak_memory'] for stamp_plan in stamp_plans),
+    }
 
 
 if __name__ == '__main__':
     # read arguments - note boolean type doesn't work as expected so do a lambda on the string for mirror and invert images
     parser = argparse.ArgumentParser(description='Wrap an image around a cylinder')
-    parser.add_argument('-i', '--image_file', nargs=1, help='Input image name', required=True)
-    parser.add_argument('-o', '--output_file', nargs=1, help='Output STL file name', required=True)
+    parser.add_argument('-i', '--image_file', nargs='+', help='Input image name(s)', required=True)
+    parser.add_argument('-o', '--output_file', nargs=1, help='Output STL file name (not needed with --plan or --preview)', default=None)
     parser.add_argument('-m', '--margin', type=float, help='Margin around the image (percentage)', default=1.0)
     parser.add_argument('-il', '--image_low', type=float, help='Low Z value for the stamp Z height (float)', default=0.0)
     parser.add_argument('-ih', '--image_high', type=float, help='High Z value for the stamp Z height (float)', default=-4.0)
@@ -337,10 +403,20 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--roundness', type=int, help='roundness of the cylinder (int)', default=6)
     parser.add_argument('-z', '--z_height', type=float, help='height of the cylinder for the stamp', default=70.0)
     parser.add_argument('-s', '--stl_type', type=str, help='STL file type - text or bin (default bin)', default='bin')
+    parser.add_argument('-c', '--copies', type=int, help='Number of copies of each image on the sheet (int)', default=1)
+    parser.add_argument('-col', '--columns', type=int, help='Number of stamps across the sheet (int - use 0 for as square as possible)', default=0)
+    parser.add_argument('-sp', '--spacing', type=float, help='Space between the stamps on the sheet (float)', default=5.0)
+    parser.add_argument('-pv', '--preview', type=str, help='Save a shaded preview image of the stamp face to this file instead of creating the STL file', default=None)
+    parser.add_argument('-ps', '--preview_size', type=int, help='Maximum width and height of the preview image (int)', default=512)
+    parser.add_argument('-p', '--plan', action='store_true', help='Print the number of facets, file size and memory needed as JSON without creating the STL file')
     args = parser.parse_args()
 
-    image_name = args.image_file[0]
-    stl_name = args.output_file[0]
+    # --plan and --preview don't create the STL file, so only need an output file otherwise
+    if args.output_file is None and not (args.plan or args.preview):
+        parser.error('the following arguments are required: -o/--output_file')
+
+    image_names = args.image_file
+    stl_name = args.output_file[0] if args.output_file else None
     margin = args.margin
     #invert_image = args.invert_image
     invert_image = True if args.invert_image else False
@@ -351,6 +427,10 @@ if __name__ == '__main__':
     outer_radius = args.outer_radius
     z_height = args.z_height
     stl_type = 'txt' if args.stl_type[0]=='txt' else 'bin'
+    plan = args.plan
+    copies = args.copies
+    columns = args.columns if args.columns > 0 else None
+    spacing = args.spacing
 
     # validate parameters...
     if margin < 0.0 or margin > 100.0:
@@ -361,6 +441,10 @@ if __name__ == '__main__':
         print("Roundness is an integer between 1 and 50")
         sys.exit(1)
 
+    if copies < 1:
+        print("Copies is an integer of at least 1")
+        sys.exit(1)
+
     options = []
 
     if mirror_image is True:
@@ -374,27 +458,46 @@ if __name__ == '__main__':
     else:
         option_str = ''
 
-    print("Creating an image stamp for image={}, output={} {}".format(image_name, stl_name, option_str))
+    if args.preview:
+        previews = []
+
+        for image_name in image_names:
+            # only decode as much of the image as the preview needs (draft only speeds up JPEG files)
+            bot_img_file = Image.open(image_name)
+            bot_img_file.draft('L', (args.preview_size, args.preview_size))
+            im, _ = preview.reduce_image(bot_img_file.convert('L'), args.preview_size)
+            vertices = calc_stamp_vertices(im, outer_radius, margin, low_z, high_z, mirror_image, invert_image)
+            previews.append(preview.render_stamp(vertices, outer_radius, args.preview_size))
+
+        preview.side_by_side(previews).save(args.preview)
+        print("Saved a preview of the stamp for image={} to {} {}".format(', '.join(image_names), args.preview, option_str))
+        sys.exit(0)
 
     segments = (roundness + 2) * 4
-    convert_to = 'L'
-    bot_img_file = Image.open(image_name)
-    im = bot_img_file.convert(convert_to)
+    images = []
+    stamp_plans = []
 
-    with pystl.PySTL(stl_name,  bin=True) as stl:
-        # create geometry for the bottom image cap
-        vertices = calc_stamp_vertices(im, outer_radius, margin, low_z, high_z, mirror_image, invert_image)
-        draw_stamp(stl, vertices)
+    # decode the next image on another thread while the heights of this one are calculated
+    for im_bands, im in background_iter(iter_stamp_images(image_names)):
+        heights = calc_stamp_heights(im, low_z, high_z, mirror_image, invert_image)
+        stamp_plans.append(plan_stamp(heights, segments, im_bands))
+        images.append(im)
 
-        # draw blank area around the stamp
-        draw_margin(stl, im, outer_radius, margin, 0.0, segments=segments)
-        draw_sidewalls(stl, vertices, outer_radius, margin, 0.0)
+    if len(images) == 1 and copies == 1:
+        stamp_plan = stamp_plans[0]
+    else:
+        stamp_plan = plan_sheet(stamp_plans, copies)
 
-        # create geometry for the cylinder sides
-        draw_hollow_cylinder(stl, outer_radius, 0.0, top_z=z_height, segments=segments)
+    if plan:
+        print(json.dumps(stamp_plan, indent=2))
+        sys.exit(0)
 
-        # draw top cap
-        draw_cylinder_cap(stl, outer_radius,z_height, segments=segments)
+    print("Creating an image stamp for image={}, output={} {}".format(', '.join(image_names), stl_name, option_str))
 
+    # the geometry is created on this thread and written on another
+    with pystl.PySTL(stl_name,  bin=True, num_triangles=stamp_plan['num_facets'], threaded=True) as stl:
+        draw_sheet(stl, images, outer_radius, margin, low_z, high_z, z_height, segments=segments,
+                   mirror_image=mirror_image, invert_image=invert_image, copies=copies, columns=columns,
+                   spacing=spacing)
 
     print("Frieze completed succesfully.")
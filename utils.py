@@ -9,6 +9,14 @@ last updated: 2/15/2018
 
 import math
 import collections
+import queue
+import threading
+
+import numpy as np
+
+from pystl import quads_to_triangles
+
+BACKGROUND_QUEUE_SIZE = 4   # default number of items background_iter keeps queued up ahead of the caller
 
 Vertex3 = collections.namedtuple('Vertex', 'x y z')
 Triangle = collections.namedtuple('Triangle', 'v1 v2 v3')
@@ -19,13 +27,15 @@ def make_triangle(d):
 
 
 def cylindrical_coord(x, rads):
-    x1 = x * math.cos(rads)
-    y1 = x * math.sin(rads)
+    # x and rads can be numbers or numpy arrays
+    x1 = x * np.cos(rads)
+    y1 = x * np.sin(rads)
     return (x1, y1)
 
 
 def calc_offset(c, max_c, scale, invert_offsets=False):
-    fc = float(c)
+    # c can be a number or a numpy array
+    fc = np.asarray(c, dtype=float)
     mc = float(max_c)
     s = float(scale)
 
@@ -36,5 +46,157 @@ def calc_offset(c, max_c, scale, invert_offsets=False):
 
 
 def lerp(low, high, a):
-    # linear interpolation of a (0.0-1.0) from low to high
+    # linear interpolation of a (0.0-1.0) from low to high - works on numpy arrays too
     return (high-low) * a + low
+
+
+def calc_segment_angles(segments):
+    """ Return the angles of the segments+1 points around a circle, with the last the same point as the first """
+    return (np.arange(segments + 1) / segments) * (math.pi * 2.0)
+
+
+def calc_ring(radius, rads, z):
+    """
+    Return the vertices at angles rads on a circle of radius at height z, as an array of shape (n, 3). radius and z
+    can also be arrays with an entry for each angle.
+    """
+    rads = np.asarray(rads, dtype=float)
+    ring = np.empty(rads.shape + (3,), dtype=float)
+    ring[..., 0], ring[..., 1] = cylindrical_coord(radius, rads)
+    ring[..., 2] = z
+    return ring
+
+
+def close_ring(ring):
+    # repeat the first vertex at the end so the last segment goes back to the start
+    return np.concatenate((ring, ring[:1]))
+
+
+def ring_quads(ring1, ring2, reverse=False):
+    """
+    Return the triangles of the quads between two rings (or any rows) of vertices, each of shape (n+1, 3), as an array
+    of shape (2n, 3, 3). Quad i is (ring1[i], ring1[i+1], ring2[i+1], ring2[i]) split the same way as PySTL.add_quad, or
+    wound the other way if reverse is True.
+    """
+    v1, v2, v3, v4 = ring1[:-1], ring1[1:], ring2[1:], ring2[:-1]
+    if reverse:
+        v1, v2, v3, v4 = v4, v3, v2, v1
+    return quads_to_triangles(v1, v2, v3, v4).reshape(-1, 3, 3)
+
+
+def fan_triangles(ring, center, reverse=False):
+    """
+    Return the triangles from each segment of a ring of vertices, of shape (n+1, 3), to center as an array of shape
+    (n, 3, 3). Triangle i is (ring[i], ring[i+1], center), or wound the other way if reverse is True.
+    """
+    v1, v2 = ring[:-1], ring[1:]
+    v3 = np.broadcast_to(np.asarray(center, dtype=float), v1.shape)
+    if reverse:
+        v2, v3 = v3, v2
+    return np.stack((v1, v2, v3), axis=1)
+
+
+def tube_triangles(radius, segments, bottom_z, top_z):
+    """ Return the triangles of the wall of a cylinder from bottom_z to top_z, facing out """
+    rads = calc_segment_angles(segments)
+    return ring_quads(calc_ring(radius, rads, bottom_z), calc_ring(radius, rads, top_z))
+
+
+def disc_triangles(radius, segments, z):
+    """ Return the triangles of a disc centered at (0,0) at height z, facing up """
+    return fan_triangles(calc_ring(radius, calc_segment_angles(segments), z), (0.0, 0.0, z))
+
+
+def annulus_triangles(inner_radius, outer_radius, segments, z):
+    """ Return the triangles of a disc with a round hole centered at (0,0) at height z, facing up """
+    rads = calc_segment_angles(segments)
+    return ring_quads(calc_ring(inner_radius, rads, z), calc_ring(outer_radius, rads, z), reverse=True)
+
+
+def disc_with_rect_hole_triangles(radius, segments, z, max_x, max_y):
+    """
+    Return the triangles of a disc centered at (0,0) at height z, facing down, with a rectangular hole from -max_x to
+    max_x and -max_y to max_y. The disc is split into quadrants (segments/4) with each segment joined to the corner
+    of the hole in its quadrant. The first and last segments of a quadrant are drawn as quads to the corner and to the
+    point where the quadrant's axis meets the edge of the hole. The rest are triangles.
+    """
+    qtr_segments = segments // 4
+    starts = np.array([0, qtr_segments, 2*qtr_segments, 3*qtr_segments, segments])
+    ring = calc_ring(radius, calc_segment_angles(segments), z)
+    v1 = ring[:-1]
+    v2 = ring[1:]
+
+    # the quadrant, its corner of the hole and where it starts and ends on the edge of the hole, for each segment
+    quadrant = np.minimum(np.searchsorted(starts, np.arange(segments), side='right') - 1, 3)
+    signs = np.array([(1.0, 1.0), (-1.0, 1.0), (-1.0, -1.0), (1.0, -1.0)])
+    axes = np.array([(1.0, 0.0), (0.0, 1.0), (-1.0, 0.0), (0.0, -1.0), (1.0, 0.0)])
+    extent = np.array([max_x, max_y])
+
+    def hole_point(xy):
+        return np.column_stack((xy * extent, np.full(segments, z, dtype=float)))
+
+    corner = hole_point(signs[quadrant])
+    axis_start = hole_point(axes[quadrant])
+    axis_end = hole_point(axes[quadrant + 1])
+
+    is_first = np.arange(segments) == starts[quadrant]
+    is_last = (np.arange(segments) == starts[quadrant + 1] - 1) & ~is_first
+
+    # every segment has a triangle to the corner (or the edge for the last) and the first and last also have one
+    # between the corner and the edge of the hole
+    quad_tris = np.where(is_first[:, np.newaxis, np.newaxis],
+                         np.stack((axis_start, corner, v1), axis=1),
+                         np.stack((corner, axis_end, v1), axis=1))
+    segment_tris = np.stack((np.where(is_last[:, np.newaxis], axis_end, corner), v2, v1), axis=1)
+
+    triangles = np.stack((quad_tris, segment_tris), axis=1)
+    has_triangle = np.column_stack((is_first | is_last, np.ones(segments, dtype=bool)))
+    return triangles[has_triangle]
+
+
+def background_iter(iterable, maxsize=BACKGROUND_QUEUE_SIZE):
+    """
+    Iterate over iterable on a separate thread, keeping up to maxsize items queued up ahead of the caller. Used to
+    run a stage of a pipeline (e.g. decoding an image and calculating its vertices) alongside the next stage.
+    Exceptions raised on the thread are raised again in the caller.
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+    error = []
+
+    def put(item):
+        # give up if the caller stops iterating, rather than wait forever on a full queue
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        # always send done, even after a KeyboardInterrupt etc., so the caller never waits forever
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            error.append(e)
+        finally:
+            put(done)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+
+    if error:
+        raise error[0]
@@ -12,163 +12,276 @@ coordinates).
         This will wrap image.png around a solid cylinder that is 70.0 millimeters for black pixels and 80 millimeters
         for white pixels. To add a hole, use the -hr command line option. Use -h to see other options.
 
+        To see how many triangles, how big a file and roughly how much memory a frieze will take without creating
+        it, use the --plan command line option. The plan is printed as JSON.
+
+        To quickly see what a frieze will look like, use the --preview command line option to save a shaded image
+        of the relief, unrolled, instead of creating the STL file (e.g. --preview preview.png).
+
+        To cut down the number of triangles, use the -t command line option to merge flat areas of the mesh into
+        bigger blocks, keeping every vertex of the full resolution surface within that many millimeters of the
+        simplified surface (e.g. -t 0.1). See simplify.py.
+
 Len Wanger
 last updated: 2/15/2016
 
 """
 
 import argparse
+import json
 import numpy as np
 import math
 from PIL import Image
+import preview
 import pystl
+import simplify
+import sys
 
-from utils import Vertex3, Triangle, cylindrical_coord, calc_offset
+from utils import BACKGROUND_QUEUE_SIZE, background_iter, calc_offset, calc_ring, close_ring, cylindrical_coord, \
+    fan_triangles, ring_quads
 
+CHUNK_COLUMNS = 64  # number of columns of vertices calculated and drawn at a time
+CHUNK_FACETS = 65536  # number of facets of a simplified mesh drawn at a time
 
-def calc_vertices(im, inner_radius, outer_radius, z_scale, invert_offsets=False, reverse_x=False):
-    vertices = np.zeros((im.width, im.height, 3), dtype=float)
-    pi2 = math.pi * 2.0
-    radians_per_pixel = pi2 / float(im.width)
-    radius_diff = outer_radius - inner_radius
-    width, height = im.width, im.height
 
-    for i in range(width):
-        for j in range(height):
-            fi = float(i) if not reverse_x else float(width-i)
-            fj = float(j)
-            c_offset = calc_offset(im.getpixel((i, j)), 255.0, radius_diff, invert_offsets)
-            x, y = cylindrical_coord((inner_radius + c_offset), (fi * radians_per_pixel))
-            z = (fj)*z_scale
-            vertices[i][j] = (x, y, z)
+def iter_vertex_columns(im, inner_radius, outer_radius, z_scale, invert_offsets=False, reverse_x=False,
+                        chunk_size=CHUNK_COLUMNS):
+    """ Yield the vertices for the image chunk_size columns at a time, each chunk indexed [i][j] like calc_vertices """
+    pixels = np.asarray(im, dtype=float).T
+    width, height = im.width, im.height
+    radians_per_pixel = (math.pi * 2.0) / float(width)
+    radius_diff = outer_radius - inner_radius
+    z = np.arange(height, dtype=float) * z_scale
 
-    return (vertices)
+    for start in range(0, width, chunk_size):
+        fi = np.arange(start, min(start + chunk_size, width), dtype=float)
+        if reverse_x:
+            fi = float(width) - fi
 
+        c_offset = calc_offset(pixels[start:start + chunk_size], 255.0, radius_diff, invert_offsets)
+        radius = inner_radius + c_offset
+        rads = (fi * radians_per_pixel)[:, np.newaxis]
+        vertices = np.empty((len(fi), height, 3), dtype=float)
+        vertices[:, :, 0], vertices[:, :, 1] = cylindrical_coord(radius, rads)
+        vertices[:, :, 2] = z
+        yield vertices
 
-def draw_cylinder(stl, vertices, reverse_x=False):
-    width, height, _ = vertices.shape
 
-    for i in range(width-1):
-        for j in range(height-1):
-            v1 = (vertices[i][j][0], vertices[i][j][1], vertices[i][j][2])
-            v2 = (vertices[i+1][j][0], vertices[i+1][j][1], vertices[i+1][j][2])
-            v3 = (vertices[i+1][j+1][0], vertices[i+1][j+1][1], vertices[i+1][j+1][2])
-            v4 = (vertices[i][j+1][0], vertices[i][j+1][1], vertices[i][j+1][2])
+def iter_image_vertex_columns(img_name, *args, **kwargs):
+    """ Decode the image then yield its vertices a chunk of columns at a time - see iter_vertex_columns """
+    im = Image.open(img_name).convert('L')
+    for vertices in iter_vertex_columns(im, *args, **kwargs):
+        yield vertices
 
-            if reverse_x:
-                stl.add_quad(v4, v3, v2, v1)
-            else:
-                stl.add_quad(v1, v2, v3, v4)
 
-    # add the seam (first to last)
-    for j in range(height-1):
-        v1 = (vertices[width-1][j][0], vertices[width-1][j][1], vertices[width-1][j][2])
-        v2 = (vertices[0][j][0], vertices[0][j][1], vertices[0][j][2])
-        v3 = (vertices[0][j+1][0], vertices[0][j+1][1], vertices[0][j+1][2])
-        v4 = (vertices[width-1][j+1][0], vertices[width-1][j+1][1], vertices[width-1][j+1][2])
+def calc_vertices(im, inner_radius, outer_radius, z_scale, invert_offsets=False, reverse_x=False):
+    return np.concatenate(list(iter_vertex_columns(im, inner_radius, outer_radius, z_scale, invert_offsets,
+                                                   reverse_x)))
 
-        if reverse_x:
-            stl.add_quad(v4, v3, v2, v1)
-        else:
-            stl.add_quad(v1, v2, v3, v4)
 
+def draw_column_quads(stl, columns, reverse_x=False):
+    # draw the quads between each pair of neighbouring columns of vertices
+    v1 = columns[:-1, :-1]
+    v2 = columns[1:, :-1]
+    v3 = columns[1:, 1:]
+    v4 = columns[:-1, 1:]
 
-def draw_end_cap_segment(stl, vertices, i1, i2, j, radians_per_pixel, reverse_x, add_hole, hole_radius, reverse_normal):
     if reverse_x:
-        width, _, _ = vertices.shape
-        fi1, fi2, fj = float(width-1-i1), float(width-1-i2), float(j)
+        stl.add_quads(v4, v3, v2, v1)
     else:
-        fi1, fi2, fj = float(i1), float(i2), float(j)
-
-    v1 = vertices[i1][j]
-    v2 = vertices[i2][j]
-
-    if add_hole:
-        x3 = hole_radius * math.cos((fi2) * radians_per_pixel)
-        y3 = hole_radius * math.sin((fi2) * radians_per_pixel)
-        x4 = hole_radius * math.cos((fi1) * radians_per_pixel)
-        y4 = hole_radius * math.sin((fi1) * radians_per_pixel)
-
-        v3 = Vertex3(x3, y3, fj*z_scale)
-        v4 = Vertex3(x4, y4, fj*z_scale)
-
-        if reverse_x ^ reverse_normal:
-            stl.add_quad(v1, v2, v3, v4)
+        stl.add_quads(v1, v2, v3, v4)
+
+
+def draw_cylinder_columns(stl, columns, reverse_x=False):
+    """
+    Draw the cylinder from an iterable of chunks of vertex columns, so each chunk can be drawn as soon as it has been
+    calculated. Returns the first and last rows of the vertices, indexed [i][j] with j of 0 and 1, for the end caps and
+    the hole.
+    """
+    first = last = None
+    ends = []
+
+    for chunk in columns:
+        if last is None:
+            first = chunk[0]
+            draw_column_quads(stl, chunk, reverse_x)
         else:
-            stl.add_quad(v4, v3, v2, v1)
-    else:
-        v3 = Vertex3(0.0, 0.0, fj*z_scale)
+            draw_column_quads(stl, np.concatenate((last[np.newaxis], chunk)), reverse_x)
 
-        if reverse_x ^ reverse_normal:
-            t1 = Triangle(v1, v2, v3)
-        else:
-            t1 = Triangle(v1, v3, v2)
+        last = chunk[-1]
+        ends.append(chunk[:, [0, -1]])
 
-        stl.add_triangle(t1)
+    # add the seam (first to last)
+    draw_column_quads(stl, np.stack((last, first)), reverse_x)
+    return np.concatenate(ends)
 
 
-def draw_end_caps(stl, vertices, j, reverse_x, add_hole=False, reverse_normal=False):
+def draw_cylinder(stl, vertices, reverse_x=False):
     width, _, _ = vertices.shape
-    pi2 = math.pi * 2.0
-    radians_per_pixel = pi2 / float(width)
-    for i in range(width-1):
-        draw_end_cap_segment(stl, vertices, i, i+1, j, radians_per_pixel, reverse_x, add_hole, hole_radius, reverse_normal)
-
-    # Draw from 0.0 to last
-    draw_end_cap_segment(stl, vertices, width-1, 0, j, radians_per_pixel, reverse_x, add_hole, hole_radius, reverse_normal)
-
+    columns = (vertices[i:i + CHUNK_COLUMNS] for i in range(0, width, CHUNK_COLUMNS))
+    draw_cylinder_columns(stl, columns, reverse_x)
 
-def draw_hole(stl, vertices, hole_radius, z_scale):
-    width, height, _ = vertices.shape
-    pi2 = math.pi * 2.0
-    radians_per_pixel = pi2 / float(width)
-    fj = float(height)
 
-    for i in range(width-1):
-        fi= float(i)
+def draw_mesh(stl, vertices, triangles, end_columns):
+    """
+    Draw a simplified mesh (from simplify.simplify_mesh) a chunk of facets at a time. Returns the first and last rows of
+    the end columns, like draw_cylinder_columns, for the end caps and the hole.
+    """
+    points = vertices.reshape(-1, 3)
+    for start in range(0, len(triangles), CHUNK_FACETS):
+        stl.add_triangles(points[triangles[start:start + CHUNK_FACETS]])
 
-        x1 = (hole_radius) * math.cos(fi * radians_per_pixel)
-        y1 = (hole_radius) * math.sin(fi * radians_per_pixel)
-        x2 = (hole_radius) * math.cos((fi+1.0) * radians_per_pixel)
-        y2 = (hole_radius) * math.sin((fi+1.0) * radians_per_pixel)
+    return vertices[end_columns][:, [0, -1]]
 
-        v1 = Vertex3(x1, y1, 0.0)
-        v2 = Vertex3(x2, y2, 0.0)
-        v3 = Vertex3(x2, y2, fj*z_scale)
-        v4 = Vertex3(x1, y1, fj*z_scale)
 
-        stl.add_quad(v4, v3, v2, v1)
+def calc_hole_ring(vertices, hole_radius, j):
+    # the hole vertices take the angle and height of the outer vertices so the cap stays attached to the ring
+    # even when the columns are not evenly spaced (i.e. a simplified mesh)
+    outer = vertices[:, j]
+    return calc_ring(hole_radius, np.arctan2(outer[:, 1], outer[:, 0]), outer[:, 2])
 
-    # draw from last to first wedge
-    x1 = (hole_radius) * math.cos((width-1.0) * radians_per_pixel)
-    y1 = (hole_radius) * math.sin((width-1.0) * radians_per_pixel)
-    x2 = (hole_radius) * math.cos((0.0) * radians_per_pixel)
-    y2 = (hole_radius) * math.sin((0.0) * radians_per_pixel)
 
-    v1 = Vertex3(x1, y1, 0.0)
-    v2 = Vertex3(x2, y2, 0.0)
-    v3 = Vertex3(x2, y2, fj*z_scale)
-    v4 = Vertex3(x1, y1, fj*z_scale)
+def draw_end_caps(stl, vertices, j, reverse_x, add_hole=False, reverse_normal=False, hole_radius=None):
+    # draw from each vertex in row j to the next, and from the last back to the first
+    outer = close_ring(vertices[:, j])
 
-    stl.add_quad(v4, v3, v2, v1)
+    if add_hole:
+        hole = close_ring(calc_hole_ring(vertices, hole_radius, j))
+        stl.add_triangles(ring_quads(outer, hole, reverse=not (reverse_x ^ reverse_normal)))
+    else:
+        center = (0.0, 0.0, outer[0][2])
+        stl.add_triangles(fan_triangles(outer, center, reverse=not (reverse_x ^ reverse_normal)))
+
+
+def draw_hole(stl, vertices, hole_radius, reverse_x=False):
+    # the hole uses the same angles and heights as the end caps so they share their edges
+    bottom = close_ring(calc_hole_ring(vertices, hole_radius, 0))
+    top = close_ring(calc_hole_ring(vertices, hole_radius, -1))
+    i1, i2 = (slice(None, -1), slice(1, None)) if not reverse_x else (slice(1, None), slice(None, -1))
+    stl.add_quads(top[i1], top[i2], bottom[i2], bottom[i1])
+
+
+def calc_num_facets(width, height, add_hole=False):
+    """ Return the number of facets drawn for each part of a frieze with a width x height vertex grid """
+    return {
+        'cylinder': 2 * (width-1) * (height-1),
+        'seam': 2 * (height-1),
+        'end_caps': 2 * width * (2 if add_hole else 1),
+        'hole': 2 * width if add_hole else 0,
+    }
+
+
+def calc_num_mesh_facets(triangles, end_columns, add_hole=False):
+    # the number of facets drawn for each part of a frieze with a simplified mesh (from simplify.simplify_mesh)
+    return {
+        'cylinder': len(triangles),     # including the seam
+        'end_caps': 2 * len(end_columns) * (2 if add_hole else 1),
+        'hole': 2 * len(end_columns) if add_hole else 0,
+    }
+
+
+def calc_chunk_memory(chunk_facets, queue_size=pystl.QUEUE_SIZE):
+    # the memory used adding a chunk of facets, with up to queue_size chunks and the one being written waiting on the
+    # writer thread
+    return chunk_facets * (pystl.ADD_TRIANGLES_FACET_BYTES + (queue_size + 1) * pystl.BIN_TRIANGLE_SIZE)
+
+
+def calc_stream_memory(width, height, chunk_size=CHUNK_COLUMNS, queue_size=pystl.QUEUE_SIZE):
+    """
+    Return an estimate of the memory used while a full resolution frieze is calculated and drawn a chunk of columns at
+    a time (see iter_vertex_columns and draw_cylinder_columns), after the image is decoded. That's the greyscale image
+    and the float64 copy of its pixels (9 bytes a pixel), and chunks of vertices (24 bytes a vertex): one being
+    calculated, along with its offsets, radii, x and y (8 bytes a vertex each), up to BACKGROUND_QUEUE_SIZE waiting for
+    the drawing, the one being drawn and the copy of it joined to the last column before. Then there are the first
+    and last rows kept for the end caps and adding the triangles of a chunk (see calc_chunk_memory). Neither queue
+    holds more chunks than there are.
+    """
+    chunk_columns = min(chunk_size, width)
+    chunk_vertices = chunk_columns * height
+    num_chunks = (width + chunk_size - 1) // chunk_size
+    pixels = width * height * (1 + 8)
+    vertices = chunk_vertices * (4 * 8 + (min(BACKGROUND_QUEUE_SIZE, num_chunks) + 3) * 3 * 8)
+    ends = width * 2 * 3 * 8
+    drawing = calc_chunk_memory(2 * chunk_columns * (height-1), min(queue_size, num_chunks))
+    return pixels + vertices + ends + drawing
+
+
+def calc_mesh_memory(width, height, num_triangles, queue_size=pystl.QUEUE_SIZE):
+    """
+    Return an estimate of the memory used while a simplified frieze is calculated, simplified and drawn, after the
+    image is decoded. calc_vertices keeps the float64 pixels (8 bytes a pixel) and every chunk of vertices while they
+    are joined (24 bytes a vertex each). Merging the blocks needs three copies of the radii (8 bytes each), the flags
+    of which blocks merge (about 4 bytes a pixel all together) and the radii of a batch of blocks being checked and
+    their temporaries, while later two copies of the radii are left as the triangles are gathered and joined (24 bytes
+    a triangle each). Drawing needs the triangles and a chunk of facets (see calc_chunk_memory), with no more chunks
+    waiting on the writer thread than there are.
+    """
+    num_pixels = width * height
+    calculating = num_pixels * (8 + 2 * 3 * 8)
+    simplifying = max(num_pixels * (3 * 8 + 4) + min(simplify.BATCH_RADII, num_pixels * 4) * 8 * 8,
+                      num_pixels * 2 * 8 + num_triangles * 2 * 3 * 8)
+    num_chunks = (num_triangles + CHUNK_FACETS - 1) // CHUNK_FACETS
+    drawing = num_triangles * 3 * 8 + calc_chunk_memory(min(CHUNK_FACETS, num_triangles), min(queue_size, num_chunks))
+    return max(calculating, num_pixels * 3 * 8 + max(simplifying, drawing))
+
+
+def plan_frieze(im_width, im_height, im_bands=1, add_hole=False, mesh=None):
+    """
+    Return the number of facets, the size of the (binary) STL file and an estimate of the peak memory for a frieze,
+    without creating any geometry. mesh is the triangles and end columns from simplify.simplify_mesh, if the mesh is
+    simplified. The memory estimate covers the decoded image and its greyscale copy, then calculating and drawing
+    the frieze (see calc_stream_memory and calc_mesh_memory).
+    """
+    num_pixels = im_width * im_height
+    decoded = num_pixels * (im_bands + 1)
+
+    if mesh is None:
+        facets = calc_num_facets(im_width, im_height, add_hole)
+        grid = {'grid': {'width': im_width, 'height': im_height}}
+        # the image is decoded on its own before the vertices are calculated
+        peak_memory = max(decoded, calc_stream_memory(im_width, im_height))
+    else:
+        triangles, end_columns = mesh
+        facets = calc_num_mesh_facets(triangles, end_columns, add_hole)
+        grid = {'mesh': {'triangles': len(triangles), 'end_columns': len(end_columns)}}
+        # the decoded image is kept while the frieze is simplified
+        peak_memory = decoded + calc_mesh_memory(im_width, im_height, len(triangles))
+
+    num_facets = sum(facets.values())
+    return {
+        'image': {'width': im_width, 'height': im_height},
+        **grid,
+        'facets': facets,
+        'num_facets': num_facets,
+        'file_size': pystl.calc_bin_file_size(num_facets),
+        'peak_memory': peak_memory,
+    }
 
 
 if __name__ == '__main__':
     # read arguments
     parser = argparse.ArgumentParser(description='Wrap an image around a cylinder')
     parser.add_argument('-i', '--image_file', nargs=1, help='Input image name', required=True)
-    parser.add_argument('-o', '--output_file', nargs=1, help='Output STL file name', required=True)
+    parser.add_argument('-o', '--output_file', nargs=1, help='Output STL file name (not needed with --plan or --preview)', default=None)
     parser.add_argument('-ir', '--inner_radius', type=float, help='Radius of minimum image value (float)', default=70.0)
     parser.add_argument('-or', '--outer_radius', type=float, help='Radius of maximum image value (float)', default=80.0)
     parser.add_argument('-hr', '--hole_radius', type=float, help='Radius of hole (float - use negative for no hole)', default=-1.0)
     parser.add_argument('-z', '--z_scale', type=float, help='Scale value for Z height (float)', default=1.0)
     parser.add_argument('-rx', '--reverse_x', type=bool, help='Reverse the x axis (bool - i.e. scan clock verses counter-clockwise)', default=False)
     parser.add_argument('-iz', '--invert_offsets', type=bool, help='Invert offset (bool - i.e. darker colors in image stick out further)', default=False)
+    parser.add_argument('-t', '--tolerance', type=float, help='Simplify the mesh so every vertex is within this many millimeters of the simplified surface (float - use negative for full resolution)', default=-1.0)
     parser.add_argument('-s', '--stl_type', type=str, help='STL file type - text or bin (default bin)', default='bin')
+    parser.add_argument('-pv', '--preview', type=str, help='Save a shaded preview image of the relief to this file instead of creating the STL file', default=None)
+    parser.add_argument('-ps', '--preview_size', type=int, help='Maximum width and height of the preview image (int)', default=512)
+    parser.add_argument('-p', '--plan', action='store_true', help='Print the number of facets, file size and memory needed as JSON without creating the STL file')
     args = parser.parse_args()
 
+    # --plan and --preview don't create the STL file, so only need an output file otherwise
+    if args.output_file is None and not (args.plan or args.preview):
+        parser.error('the following arguments are required: -o/--output_file')
+
     img_name = args.image_file[0]
-    stl_name = args.output_file[0]
+    stl_name = args.output_file[0] if args.output_file else None
     inner_radius = args.inner_radius
     outer_radius = args.outer_radius
     hole_radius = args.hole_radius
@@ -178,20 +291,60 @@ if __name__ == '__main__':
     reverse_x = True if args.reverse_x else False
     invert_offsets = args.invert_offsets
     radius_diff = outer_radius - inner_radius
+    tolerance = args.tolerance
 
-    print("Creating a cylindrical frieze for image={}, output={}".format(img_name, stl_name))
+    plan = args.plan
 
     convert_to = 'L'
     _ = Image.open(img_name)
-    im = _.convert(convert_to)
-
-    with pystl.PySTL(stl_name,  bin=True) as stl:
+    im_bands = len(_.getbands())
+
+    if args.preview:
+        # only decode as much of the image as the preview needs (draft only speeds up JPEG files)
+        original_height = _.height
+        _.draft(convert_to, (args.preview_size, args.preview_size))
+        im, _ = preview.reduce_image(_.convert(convert_to), args.preview_size)
+        # each row of the reduced image covers this many rows of the original, between draft and reduce_image
+        factor = original_height / float(im.height)
+        vertices = calc_vertices(im, inner_radius, outer_radius, z_scale * factor, invert_offsets=invert_offsets,
+                                 reverse_x=reverse_x)
+        preview.render_relief(vertices, args.preview_size).save(args.preview)
+        print("Saved a preview of the frieze for image={} to {}".format(img_name, args.preview))
+        sys.exit(0)
+
+    if tolerance > 0.0:
+        # simplifying needs all of the vertices up front
+        im = _.convert(convert_to)
         vertices = calc_vertices(im, inner_radius, outer_radius, z_scale, invert_offsets=invert_offsets, reverse_x=reverse_x)
-        draw_cylinder(stl, vertices, reverse_x)
-        draw_end_caps(stl, vertices, 0, reverse_x, add_hole=add_hole)
-        draw_end_caps(stl, vertices, im.height-1, reverse_x, add_hole=add_hole, reverse_normal=True)
+        mesh = simplify.simplify_mesh(vertices, tolerance, reverse_x)
+        frieze_plan = plan_frieze(im.width, im.height, im_bands, add_hole, mesh=mesh)
+    else:
+        # the image size is all that's needed, so don't bother decoding it yet
+        frieze_plan = plan_frieze(_.width, _.height, im_bands, add_hole)
+
+    if plan:
+        print(json.dumps(frieze_plan, indent=2))
+        sys.exit(0)
+
+    print("Creating a cylindrical frieze for image={}, output={}".format(img_name, stl_name))
+
+    if tolerance > 0.0:
+        print("Simplified to {} triangles (tolerance={} mm)".format(len(mesh[0]), tolerance))
+
+    # the columns are drawn on this thread and written on another. Without a tolerance the image is also decoded and
+    # the vertices calculated on a third thread, a chunk of columns ahead of the drawing
+    with pystl.PySTL(stl_name,  bin=True, num_triangles=frieze_plan['num_facets'], threaded=True) as stl:
+        if tolerance > 0.0:
+            ends = draw_mesh(stl, vertices, *mesh)
+        else:
+            columns = background_iter(iter_image_vertex_columns(img_name, inner_radius, outer_radius, z_scale,
+                                                                invert_offsets=invert_offsets, reverse_x=reverse_x))
+            ends = draw_cylinder_columns(stl, columns, reverse_x)
+
+        draw_end_caps(stl, ends, 0, reverse_x, add_hole=add_hole, hole_radius=hole_radius)
+        draw_end_caps(stl, ends, 1, reverse_x, add_hole=add_hole, reverse_normal=True, hole_radius=hole_radius)
 
         if add_hole:
-           draw_hole(stl, vertices, hole_radius, z_scale)
+           draw_hole(stl, ends, hole_radius, reverse_x)
 
-    print("Frieze completed succesfully.")
\ No newline at end of file
+    print("Frieze completed succesfully.")